@@ -3,16 +3,25 @@
     A copy of the MIT License can be found in LICENSE.txt
 """
 
-import time
 import math
 import logging
 import threading
 
 from motor_controller import MotorController
-from vision_controller import VisionController, MarkerFilter, Marker, Token
+from vision_controller import (VisionController, MarkerFilter, MarkerFrame,
+                               MarkerQuery, Marker, Token)
 from sr import MARKER_ROBOT
 from servo_controller import ServoController
 from ruggeduino_controller import RuggeduinoController
+import clock
+import recorder
+import profiler
+import pose
+from tracker import PoseTracker
+from planner import GridPlanner
+from turn_gain import TurnGain
+from sensors import SensorService
+from log_sink import lazy
 from threads import *
 from state_utils import StateInterrupt
 
@@ -20,6 +29,17 @@ UP, DOWN, MIDDLE = ('UP', 'DOWN', 'MIDDLE')
 OPEN, CLOSE = ('OPEN', 'CLOSE')
 CENTER, WHEEL = ('center', 'wheel')
 WHEEL_SPAN = 0.378
+FRAME_CACHE_MAX_AGE = 1.5 # seconds a frame is reused for while stood still
+STATS_INTERVAL = 30 # seconds between capture statistics dumps to the log
+# A stop requested from another thread cuts the motors straight away, the
+# control thread waits in slices of at most STOP_LATENCY seconds so it wakes
+# within that and raises StateInterrupt (see tests.stop_latency_test).
+STOP_LATENCY = 0.05
+BLEND_RADIUS = 0.3 # largest radius of the arc replacing a Path corner
+BLEND_MAX_ANGLE = 120 # sharper corners are turned on the spot
+TRACK_ERROR = 0.3 # meters, least sure tracked pose drive_to will go from
+MIN_TURN = 1.0 # degrees, drive_to and turn_to leave smaller turns out
+MAX_LEGS = 8 # straight legs navigate_to drives before giving up
 
 class IOInterface(object):
 
@@ -36,12 +56,29 @@ class IOInterface(object):
             raise
         try:
             self.running = True
-            tr = ThreadRegister(self)
-            #self.bump_thread = BumpThread()
+            self._control_thread = threading.current_thread()
+            self._preempt = threading.Event() # set to cut the motion short
+            self._motion_time = clock.time() # when the robot last moved
+            self.motion_epoch = 0 # bumped by every drive and servo move
+            self._frame_cache = None # (epoch, timestamp, res, markers)
+            self._last_scan = None # (res, distance) to report to the policy
+            self.turn_gain = TurnGain()
+            # Called with each movement before it runs, return the servo
+            # moves that have to finish first
+            self.motion_guards = [self._grabber_guard]
+            # Returns the clock time waits on the control thread have to end
+            # by, or None
+            self.deadline = None
+            self._turn_check = None # (epoch, rotation, markers before it)
+            self._stats_logged = clock.time()
+            self.cache_stats = {'hit': 0, 'miss': 0}
+            self.pose = None # the last Pose solved from the markers
+            self.tracker = None # see start_tracking
+            self.planner = GridPlanner()
+            self.navigating = False # in navigate_to, steering around obstacles
+            self.thread_register = ThreadRegister(self)
             self._bump_callback = lambda s: None
             self._marker_callback = lambda m: None
-            #tr.add_thread(self.bump_thread)
-            #self.bump_thread.start()
         except Exception as e:
             self.log.critical("Unable to start threads")
             self.log.exception(e)
@@ -63,6 +100,11 @@ class IOInterface(object):
         #self.bump_BkR = RuggeduinoController(robot, type='bump', id='BACK_R')
         self.token_sensL = RuggeduinoController(robot, type='sensor', id='TOKEN_L')
         self.token_sensR = RuggeduinoController(robot, type='sensor', id='TOKEN_R')
+        self.sensors = SensorService()
+        #for bump in [self.bump_FrL, self.bump_FrR, self.bump_BkL, self.bump_BkR]:
+        #    self.sensors.register(bump, debounce=0.02, on_rise=self.bumped)
+        self.sensors.register(self.token_sensL, debounce=0.05)
+        self.sensors.register(self.token_sensR, debounce=0.05)
 
     def _setup_switch_sources(self, robot):
         #for id in ['FRONT_L', 'FRONT_R', 'BACK_L', 'BACK_R']:
@@ -74,12 +116,180 @@ class IOInterface(object):
         if not isinstance(instruction, MoveInstruction):
             raise TypeError("Invalid movement instruction")
         self.log.debug("Do movement %s", instruction)
-        instruction.action(self)
+        if self._time_left() <= 0:
+            raise StateInterrupt('deadline', 'operation.deadline')
+        if not isinstance(instruction, Path): # held segment by segment
+            self.hold(instruction)
+        rec = recorder.active()
+        if rec is not None:
+            rec.move(instruction)
+        cache = self._frame_cache
+        before = None
+        if cache is not None and cache[0] == self.motion_epoch:
+            before = cache[3] # the markers in view just before this move
+        try:
+            with profiler.measure('turn' if isinstance(instruction, Rotation)
+                                  else 'drive'):
+                instruction.action(self)
+        finally:
+            self._moved()
+            if self.tracker is not None:
+                for left, right in instruction.odometry(self):
+                    self.tracker.predict(left, right)
+        if isinstance(instruction, Rotation) and before:
+            self._turn_check = (self.motion_epoch, instruction, before)
+
+    def held_by(self, instruction):
+        """Returns the servo moves the motion guards hold the instruction
+        back for."""
+        return [move for guard in self.motion_guards
+                for move in guard(instruction)
+                if move is not None and not move.done()]
+
+    def hold(self, instruction):
+        """Wait for the servo moves holding the instruction back."""
+        moves = self.held_by(instruction)
+        if moves:
+            self.log.debug("%s waits for %s", instruction, moves)
+            self.join(*moves)
+
+    def _moved(self):
+        self.motion_epoch += 1
+        self._motion_time = clock.time()
+
+    def get_pose(self, markers=None):
+        """Returns the Pose solved from the arena and slot markers in view, or
+        None if there are not enough of them."""
+        if markers is None:
+            markers = self.get_markers()
+        found = pose.solve(markers)
+        if found is not None:
+            self.pose = found
+            self.log.debug("Pose %s", found)
+        return found
+
+    def start_tracking(self, x, y, heading):
+        """Keep track of the pose from here on, starting from the arena
+        position and heading given."""
+        self.tracker = PoseTracker(x, y, heading, WHEEL_SPAN)
+
+    def where(self, max_error=None):
+        """Returns the tracked Pose, or None if the pose isn't tracked or is
+        less certain than max_error meters."""
+        if self.tracker is None:
+            return None
+        if max_error is not None and self.tracker.error > max_error:
+            return None
+        return self.tracker.pose
+
+    def _locate(self):
+        """Returns the tracked Pose after a look around, or the Pose solved
+        from the markers in view if the tracked one is too uncertain."""
+        found = self.get_pose()
+        return self.where(TRACK_ERROR) or found
+
+    def turn_to(self, x, y, position=None):
+        """Turn to face the arena point. Returns False without moving if the
+        robot can't tell where it is."""
+        if position is None:
+            position = self._locate()
+        if position is None:
+            return False
+        meters, turn = pose.course_to(position, x, y)
+        if abs(turn) >= MIN_TURN:
+            self.turn((Left if turn > 0 else Right)(abs(turn), Speed(50)))
+        return True
+
+    def drive_to(self, x, y, speed, heading=None, position=None):
+        """Drive straight to the arena point, then turn to the heading if
+        given, from the position given or where the robot is now. Returns
+        False without moving if the robot can't tell where it is."""
+        if position is None:
+            position = self._locate()
+        if position is None:
+            return False
+        self.log.info("Drive %.2fm to (%.2f, %.2f) from %s",
+                      math.hypot(x - position.x, y - position.y), x, y,
+                      position)
+        self.drive(self._path_through(position, [(x, y)], speed, heading))
+        return True
+
+    def path_to(self, x, y, speed, heading=None, position=None):
+        """Returns the Path around the walls, the platform and the robots seen
+        to the arena point, turning to the heading at the end if given, or
+        None if there is no way there or the robot can't tell where it is."""
+        if position is None:
+            position = self._locate()
+        if position is None:
+            return None
+        points = self._plan(x, y, position)
+        if points is None:
+            return None
+        return self._path_through(position, points, speed, heading)
+
+    def navigate_to(self, x, y, speed, heading=None):
+        """Drive to the arena point a leg of the planned path at a time, looking
+        around and replanning after each. Returns False if the robot can't tell
+        where it is or there is no way there."""
+        self.navigating = True
+        try:
+            for leg in range(MAX_LEGS):
+                position = self._locate()
+                if position is None:
+                    return False
+                points = self._plan(x, y, position)
+                if points is None:
+                    return False
+                self.log.info("Navigate to (%.2f, %.2f) from %s through %s",
+                              x, y, position, lazy(self._fmt_points, points))
+                if len(points) == 1:
+                    self.drive(self._path_through(position, points, speed,
+                                                  heading))
+                    return True
+                self.drive(self._path_through(position, points[:1], speed))
+            return False
+        finally:
+            self.navigating = False
+
+    def _plan(self, x, y, position):
+        """Returns the arena points of the planned legs from the position to
+        the point, or None if there is no way there."""
+        self.planner.set_goal(x, y)
+        points = self.planner.plan(position.x, position.y)
+        if points is None:
+            self.log.warning("No way to (%.2f, %.2f) from %s", x, y, position)
+            return None
+        points = points[1:]
+        points[-1] = (x, y) # the middle of the goal cell is near enough
+        return points
+
+    @staticmethod
+    def _fmt_points(points):
+        return " ".join("(%.2f, %.2f)" % point for point in points)
+
+    def _path_through(self, position, points, speed, heading=None):
+        """Returns the Path of turns and straight legs from the position
+        through the arena points."""
+        path = []
+        for x, y in points:
+            meters, turn = pose.course_to(position, x, y)
+            if abs(turn) >= MIN_TURN:
+                path.append((Left if turn > 0 else Right)(abs(turn),
+                                                          Speed(50)))
+            path.append(Distance(meters, speed))
+            position = position._replace(x=x, y=y,
+                                         heading=position.heading + turn)
+        if heading is not None:
+            turn = (heading - position.heading + 180) % 360 - 180
+            if abs(turn) >= MIN_TURN:
+                path.append((Left if turn > 0 else Right)(abs(turn),
+                                                          Speed(50)))
+        return Path(*path)
 
     def goto_marker(self, marker, speed, comparator=None, offset=0):
         self.log.debug("goto marker %s %.1f", marker, speed)
         if comparator is None or not hasattr(comparator, '__call__'):
-            comparator = lambda a, b: a.info.code == b.info.code
+            comparator = None # look up by code in the frame index
         reached = False
         blind_spot = 0.66
         while True: # Alternatively, on each new find, call goto_marker within
@@ -98,11 +308,18 @@ class IOInterface(object):
             if reached: # set below
                 self.log.info("Reached marker")
                 break
-            potential_markers = [] # new markers of the same type stored here
-            for new_marker in self.get_markers():
-                if comparator(new_marker, marker):
-                    potential_markers.append(new_marker) # append based on comparator
+            scan_dist = max(0, marker.dist - travel_dist)
+            frame = self.get_markers(distance=scan_dist)
+            if comparator is None:
+                potential_markers = frame.by_code(marker.info.code)
+            else:
+                potential_markers = [] # new markers of the same type stored here
+                for new_marker in frame:
+                    if comparator(new_marker, marker):
+                        potential_markers.append(new_marker) # append based on comparator
             closest = self.get_closest_marker(potential_markers) # closest new
+            if closest is not None or travel_dist >= blind_spot:
+                self._scan_result(closest is not None)
             if closest is None: # there are no markers found
                 if travel_dist < blind_spot: # we have traveled beyond blind_spot
                     self.log.info("Distance to go in blind_spot (%.4f)",
@@ -176,22 +393,20 @@ class IOInterface(object):
         self.face_marker_3(marker, speed) # face the marker
         markers = self.get_markers() # rescan for the marker
         old_marker = marker
-        for new_marker in markers:
-            if new_marker.info.code == marker.info.code:
-                marker = new_marker
-                self.log.debug("Found marker, continuing")
-                break
+        for new_marker in markers.by_code(marker.info.code):
+            marker = new_marker
+            self.log.debug("Found marker, continuing")
+            break
         if marker is old_marker: # the marker got lost
             self.log.warning("Could not find marker")
             return False
         if self.goto_marker(marker, speed, comparator):
             return True
         markers = self.get_markers() # rescan for the marker
-        for new_marker in markers:
-            if new_marker.info.code == marker.info.code:
-                marker = new_marker
-                self.log.debug("Found marker again, continuing")
-                break
+        for new_marker in markers.by_code(marker.info.code):
+            marker = new_marker
+            self.log.debug("Found marker again, continuing")
+            break
         if marker is old_marker: # the marker got lost
             self.log.warning("Could not find marker")
             return False
@@ -199,9 +414,12 @@ class IOInterface(object):
         
 
     def is_holding_token(self):
-        return self.token_sensL.read() or self.token_sensR.read()
+        return any(self.sensors.read_many([self.token_sensL,
+                                           self.token_sensR]))
 
     def move_arm(self, direction, delay=False):
+        """Start the arm moving, returns the ServoMove to wait on. With delay
+        this waits for the move to finish."""
         if direction not in [UP, DOWN, MIDDLE]:
             raise TypeError("Invalid arm movement")
         if direction == UP:
@@ -211,30 +429,158 @@ class IOInterface(object):
         elif direction == MIDDLE:
             angle = self.arm.MAX / 2
         self.log.debug("Move arm %s (angle = %d)", direction, angle)
-        self.arm.set_angle(angle)
-        if delay:
-            self.wait(0.5)
+        return self._servo_move(self.arm, angle, delay)
 
     def open_grabber(self, delay=False):
         self.log.debug("OPEN grabber (angle = %d)", self.grabber.MIN)
-        self.grabber.set_angle(self.grabber.MIN)
-        if delay:
-            self.wait(0.7)
+        return self._servo_move(self.grabber, self.grabber.MIN, delay)
 
     def close_grabber(self, delay=False):
         self.log.debug("CLOSE grabber (angle = %d)", self.grabber.MAX)
-        self.grabber.set_angle(self.grabber.MAX)
-        if delay:
-            self.wait(0.7)
+        return self._servo_move(self.grabber, self.grabber.MAX, delay)
 
-    def get_markers(self, _filter=None):
-        markers = self.camera.find_markers()
+    def _servo_move(self, servo, angle, delay):
+        move = servo.set_angle(angle)
+        if delay:
+            self.join(move)
+        self._moved()
+        return move
+
+    def join(self, *moves):
+        """Wait until all the given servo moves are predicted to be done, or
+        all the servo moves in progress if none are given. Drives and turns
+        run alongside servo moves until they are joined."""
+        if not moves:
+            moves = [self.arm.moving(), self.grabber.moving()]
+        remaining = max([move.remaining() for move in moves
+                         if move is not None] or [0])
+        if remaining > 0:
+            with profiler.measure('servo'):
+                self.wait(remaining)
+
+    def _grabber_guard(self, instruction):
+        """Never drive forward with the grabber part way open or closed, it
+        would catch on the token."""
+        if instruction.drives_forward():
+            return [self.grabber.moving()]
+        return []
+
+    def start_capture(self):
+        """Keep capturing frames in the background so get_markers only waits
+        for a frame taken after the robot last moved."""
+        if self.camera.capturing:
+            return
+        self.camera.capturing = True
+        thread = CaptureThread()
+        self.thread_register.add_thread(thread)
+        thread.start()
+
+    def stop_capture(self):
+        self.camera.stop_capture()
+
+    def start_sensors(self):
+        """Poll the registered sensors on a background thread, reads are then
+        served from the latest poll."""
+        if self.sensors.polling:
+            return
+        self.sensors.polling = True
+        thread = SensorThread()
+        self.thread_register.add_thread(thread)
+        thread.start()
+
+    def stop_sensors(self):
+        self.sensors.polling = False
+
+    def get_markers(self, _filter=None, fresh=False, distance=None):
+        """Returns the MarkerFrame in view, of only the marker types in _filter
+        if given. If nothing moved since the last capture and it is recent
+        enough that frame is used again, unless fresh is set.
+        Give the distance of the marker looked for to let the resolution policy
+        use a cheaper capture, otherwise the full resolution is used."""
+        res = self.camera.policy.choose(distance)
+        cache = self._frame_cache
+        self._last_scan = None
+        if (not fresh and cache is not None and cache[0] == self.motion_epoch
+                and clock.time() - cache[1] <= FRAME_CACHE_MAX_AGE
+                and cache[2][0] >= res[0]):
+            self.cache_stats['hit'] += 1
+            markers = cache[3]
+        else:
+            self.cache_stats['miss'] += 1
+            epoch = self.motion_epoch
+            frame = None
+            with profiler.measure('capture'):
+                if self.camera.capturing:
+                    res = self.camera.res
+                    frame = self.camera.latest_frame(self._motion_time,
+                                                     timeout=2)
+                    if frame is None:
+                        self.log.warning("No frame from capture thread")
+                if frame is None:
+                    frame = self.camera.capture(res)
+                    if distance is not None:
+                        self._last_scan = (res, distance)
+            self._frame_cache = (epoch, frame[0], res, frame[1])
+            markers = frame[1]
+            self._check_turn(epoch, markers)
+            if self.tracker is not None:
+                self.tracker.correct(markers)
+                self._see_robots(markers)
         self._marker_callback(markers)
-        self.log.debug("get_markers %s", str(self.camera.fmt_markers(markers)))
+        self.log.debug("get_markers %s", lazy(self.camera.fmt_markers, markers))
         if _filter is not None:
-            markers = filter(lambda m: m.info.marker_type in _filter, markers)
+            markers = markers.select(_filter)
         return markers
 
+    def _see_robots(self, markers):
+        """Block the planner's cells around the robots in the frame."""
+        position = self.where(TRACK_ERROR)
+        if position is None:
+            return
+        for marker in markers.by_type(MARKER_ROBOT):
+            self.planner.see_robot(marker.info.code,
+                                   *pose.arena_position(position, marker))
+
+    def _check_turn(self, epoch, markers):
+        """Feed the turn gain model from the markers seen either side of the
+        last turn, if nothing else moved in between."""
+        check, self._turn_check = self._turn_check, None
+        if check is None or check[0] != epoch:
+            return
+        rotation = check[1]
+        change = self.turn_gain.bearing_change(check[2], markers)
+        if change is None or rotation.completed < 1 or rotation.speed <= 0:
+            return
+        if isinstance(rotation, Right):
+            change = -change # markers move left as the robot turns right
+        # The turn ran for 1/gain of the time, uncorrected it would have gone
+        # gain times as far
+        turned = change * rotation.gain
+        if self.turn_gain.observe(rotation.speed, rotation.pivot,
+                                  rotation.degree, turned):
+            self.log.debug("%s turned %.1f degrees", rotation, change)
+
+    def log_stats(self, force=False):
+        """Dump the capture statistics to the log at most every
+        STATS_INTERVAL seconds."""
+        now = clock.time()
+        if force or now - self._stats_logged >= STATS_INTERVAL:
+            self._stats_logged = now
+            self.camera.log_stats(self.log)
+            self.log.info("Frame cache %s", dict(self.cache_stats))
+            self.log.info("Turn gain %s", self.turn_gain)
+            if self.tracker is not None:
+                self.log.info("Tracked pose %s", self.tracker)
+                self.log.info("Planner %d cells expanded, robots %s",
+                              self.planner.expanded, self.planner.robots)
+
+    def _scan_result(self, found):
+        """Tell the resolution policy if the last scan found its marker."""
+        if self._last_scan is not None:
+            res, distance = self._last_scan
+            self.camera.policy.record_result(res, distance, found)
+            self._last_scan = None
+
     def get_closest_marker(self, markers):
             self.log.debug("Get closest marker to robot")
             return self.camera.get_closest(markers)
@@ -244,17 +590,57 @@ class IOInterface(object):
         return self.camera.get_rotation_nearest(markers, degree)
 
     def _stop_operation(self, filter=None):
+        """Stop the wheels and interrupt the current state. From any other
+        thread than the control thread the motion in progress is cut short
+        and the StateInterrupt raised by the control thread instead."""
         self.log.info("Stopping current action")
         try:
             self.right_wheel.stop()
             self.left_wheel.stop()
         except Exception as e:
             self.log.exception(e)
+        self._moved()
+        if threading.current_thread() is not self._control_thread:
+            self._preempt.set()
+            return
+        self._preempt.clear()
         raise StateInterrupt('stop', 'operation.stop')
 
     def wait(self, seconds):
+        """Sleep for the given seconds. Waits on the control thread return
+        early once a stop is requested or the deadline passes and raise
+        StateInterrupt."""
+        if threading.current_thread() is not self._control_thread:
+            clock.sleep(seconds)
+            return
         self.log.debug("Wait %.4f seconds", seconds)
-        time.sleep(seconds)
+        timeout = min(seconds, self._time_left())
+        end = clock.time() + timeout
+        with profiler.measure('wait'):
+            left = timeout
+            while True:
+                preempted = clock.wait(self._preempt, min(left, STOP_LATENCY))
+                left = end - clock.time()
+                if preempted or left <= 0:
+                    break
+        if preempted:
+            self._preempt.clear()
+            self.log.info("Wait cut short by a stop request")
+            raise StateInterrupt('stop', 'operation.stop')
+        if timeout < seconds:
+            self.log.info("Wait cut short by the deadline")
+            raise StateInterrupt('deadline', 'operation.deadline')
+
+    def _time_left(self):
+        """Returns the seconds until the deadline, infinity if there is no
+        deadline or this is not the control thread."""
+        if (self.deadline is None or
+                threading.current_thread() is not self._control_thread):
+            return float('inf')
+        deadline = self.deadline()
+        if deadline is None:
+            return float('inf')
+        return deadline - clock.time()
 
     def set_bump_handler(self, callback):
         self._bump_callback = callback
@@ -277,7 +663,11 @@ class IOInterface(object):
 
     def stop(self):
         self.log.info("Stopping all communications")
+        self.log_stats(True)
         self.running = False
+        self._preempt.set()
+        self.stop_capture()
+        self.stop_sensors()
 
 class MoveInstruction(object):
     def __init__(self, *args):
@@ -286,6 +676,7 @@ class MoveInstruction(object):
             raise TypeError("%s must be properly sub classed" % name)
         self.reverse = False
         self.speed = None
+        self.completed = 0.0 # fraction of the movement done
         self.setup(*args)
         self._repr = "<IO.%s%s>" % (name, str(args))
 
@@ -304,6 +695,48 @@ class MoveInstruction(object):
         io.left_wheel.stop()
         io.right_wheel.stop()
 
+    def drives_forward(self):
+        return bool(self.speed) and not self.reverse
+
+    def directions(self):
+        """Returns the (left, right) wheel directions, 1, -1 or 0 if still."""
+        flip = -1 if self.reverse else 1
+        return flip, flip
+
+    def odometry(self, io):
+        """Returns the [(left, right)] meters each wheel has moved so far,
+        forwards positive, in order."""
+        left, right = self.directions()
+        meters = self.meters * self.completed
+        return [(left * meters, right * meters)]
+
+    @property
+    def covered(self):
+        """The meters, seconds or degrees actually covered."""
+        return self.amount * self.completed
+
+    def timed_wait(self, io, seconds, start=None, total=None):
+        """Wait for seconds of the movement (started at start, lasting total
+        seconds). If the wait is cut short the motors are stopped and the
+        fraction completed is kept before the interrupt is raised again."""
+        if start is None:
+            start = clock.time()
+        if total is None:
+            total = seconds
+        waited = clock.time() - start
+        try:
+            io.wait(seconds)
+        except StateInterrupt:
+            self.stop_motors(io)
+            if total > 0:
+                self.completed = min(1.0, (clock.time() - start) / total)
+            raise
+        done = waited + seconds
+        if total <= 0 or done >= total * 0.999: # allow for rounding
+            self.completed = 1.0
+        else:
+            self.completed = done / total
+
 class Distance(MoveInstruction):
     def setup(self, meters, speed, stop=True):
         if meters < 0:
@@ -311,7 +744,7 @@ class Distance(MoveInstruction):
             meters = -meters
         else:
             self.reverse = False
-        self.meters = meters
+        self.meters = self.amount = meters
         self.speed = speed
         self.stop = stop
 
@@ -319,7 +752,7 @@ class Distance(MoveInstruction):
         self.drive_motors(io)
         time1 = io.left_wheel.calc_wait_time(self.meters, self.speed)
         time2 = io.right_wheel.calc_wait_time(self.meters, self.speed)
-        io.wait(max(time1, time2))
+        self.timed_wait(io, max(time1, time2))
         #if time1 > time2: # if left wheel takes longer than right wheel
         #    io.right_wheel.stop()
         #elif time2 > time1: # if right wheel takes longer than left wheel
@@ -330,7 +763,7 @@ class Distance(MoveInstruction):
 
 class Time(MoveInstruction):
     def setup(self, seconds, speed=None, stop=True):
-        self.seconds = seconds
+        self.seconds = self.amount = seconds
         self.speed = speed
         if speed is not None:
             if speed < 0:
@@ -342,10 +775,18 @@ class Time(MoveInstruction):
 
     def action(self, io):
         self.drive_motors(io)
-        io.wait(self.seconds)
+        self.timed_wait(io, self.seconds)
         if self.stop:
             self.stop_motors(io)
 
+    def odometry(self, io):
+        if not self.speed:
+            return [(0.0, 0.0)]
+        seconds = self.seconds * self.completed
+        left, right = self.directions()
+        return [(left * io.left_wheel.calc_distance(seconds, self.speed),
+                 right * io.right_wheel.calc_distance(seconds, self.speed))]
+
 class Speed:
     def __init__(self, speed):
         self.speed = speed
@@ -354,10 +795,13 @@ class Speed:
 
 class Rotation(MoveInstruction):
     def __init__(self, degree, measure, pivot=CENTER, stop=True):
-        self.degree = degree = abs(degree)
+        self.degree = self.amount = degree = abs(degree)
         self.left_wheel_action = None
         self.right_wheel_action = None
+        self.gain = 1.0 # turn gain correction applied
         self.stop = stop
+        self.pivot = pivot
+        self.measure = measure
         super(Rotation, self).__init__(measure, pivot)
         self._repr = "<IO.%s%s>" % (self.__class__.__name__, (degree, measure,
                                                               pivot))
@@ -380,14 +824,30 @@ class Rotation(MoveInstruction):
             getattr(io.left_wheel, self.left_wheel_action)(self.speed)
         if self.right_wheel_action is not None:
             getattr(io.right_wheel, self.right_wheel_action)(self.speed)
-        time1, time2 = self.time_func(io)
-        io.wait(min(time1, time2))
+        # Scale the turn by how far turns at this speed and pivot really go
+        self.gain = io.turn_gain.gain(self.speed, self.pivot)
+        time1, time2 = [t / self.gain for t in self.time_func(io)]
+        start, total = clock.time(), max(time1, time2)
+        self.timed_wait(io, min(time1, time2), start, total)
         if time1 > time2: # if left wheel takes longer than right wheel
             io.right_wheel.stop()
         elif time2 > time1: # if right wheel takes longer than left wheel
             io.left_wheel.stop()
-        io.wait(abs(time1 - time2))
-        self.stop_motors(io)
+        self.timed_wait(io, abs(time1 - time2), start, total)
+        if self.stop:
+            self.stop_motors(io)
+
+    def drives_forward(self):
+        return False # turning on the spot
+
+    def directions(self):
+        sign = {'forward': 1, 'backward': -1, None: 0}
+        return sign[self.left_wheel_action], sign[self.right_wheel_action]
+
+    def odometry(self, io):
+        left, right = self.directions()
+        meters = self.dist * self.completed
+        return [(left * meters, right * meters)]
 
     def calc_dist(self, point):
         """Returns the distance the driving wheel needs to turn given the point
@@ -410,3 +870,146 @@ class Left(Rotation):
         self.right_wheel_action = 'forward'
         if pivot == WHEEL:
             self.left_wheel_action = None
+
+class Arc(MoveInstruction):
+    """Drive meters along a circular arc while turning by degree, to the
+    right if degree is positive."""
+
+    def setup(self, meters, degree, speed, stop=True):
+        self.reverse = meters < 0
+        self.meters = self.amount = abs(meters)
+        self.degree = degree
+        self.speed = speed
+        self.stop = stop
+
+    def wheel_distances(self):
+        """Returns the (left, right) distance each wheel travels."""
+        half = math.radians(abs(self.degree)) * WHEEL_SPAN / 2
+        outer, inner = self.meters + half, self.meters - half
+        if (self.degree > 0) != self.reverse:
+            return outer, inner
+        return inner, outer
+
+    def directions(self):
+        flip = -1 if self.reverse else 1
+        return tuple(cmp(dist, 0) * flip for dist in self.wheel_distances())
+
+    def odometry(self, io):
+        flip = -1 if self.reverse else 1
+        return [tuple(flip * dist * self.completed
+                      for dist in self.wheel_distances())]
+
+    def action(self, io):
+        dists = self.wheel_distances()
+        wheels = (io.left_wheel, io.right_wheel)
+        seconds = max(wheel.calc_wait_time(dist, self.speed)
+                      for wheel, dist in zip(wheels, dists))
+        if seconds <= 0:
+            self.completed = 1.0
+            return
+        for wheel, dist in zip(wheels, dists):
+            speed = min(100, wheel.calc_speed(dist, seconds))
+            if (dist < 0) != self.reverse:
+                wheel.backward(speed)
+            else:
+                wheel.forward(speed)
+        self.timed_wait(io, seconds)
+        if self.stop:
+            self.stop_motors(io)
+
+class Path(MoveInstruction):
+    """Runs a sequence of Distance, Rotation and Arc instructions as one
+    movement. Straights in the same direction are merged, a turn between two
+    straights is cut with an arc ending at the same place and heading, and the
+    motors are only stopped where a wheel has to change direction."""
+
+    def setup(self, *instructions):
+        for instruction in instructions:
+            if not isinstance(instruction, (Distance, Rotation, Arc)):
+                raise TypeError("Invalid path instruction %s" % instruction)
+        self.segments = self.plan(instructions)
+        self.meters = self.amount = sum(self._length(segment)
+                                        for segment in self.segments)
+
+    @staticmethod
+    def _length(segment):
+        return getattr(segment, 'meters', 0)
+
+    @staticmethod
+    def _copy(instruction):
+        if isinstance(instruction, Distance):
+            meters = instruction.meters
+            if instruction.reverse:
+                meters = -meters
+            return Distance(meters, instruction.speed)
+        if isinstance(instruction, Rotation):
+            return instruction.__class__(instruction.degree,
+                                         instruction.measure, instruction.pivot)
+        meters = -instruction.meters if instruction.reverse else instruction.meters
+        return Arc(meters, instruction.degree, instruction.speed)
+
+    def plan(self, instructions):
+        segments = []
+        for instruction in map(self._copy, instructions):
+            last = segments[-1] if segments else None
+            if (isinstance(instruction, Distance) and
+                    isinstance(last, Distance) and
+                    last.reverse == instruction.reverse):
+                last.meters += instruction.meters
+                last.speed = min(last.speed, instruction.speed)
+                last.amount = last.meters
+            else:
+                segments.append(instruction)
+        i = 0
+        while i + 2 < len(segments):
+            arc = self._blend(*segments[i:i + 3])
+            if arc is not None:
+                segments[i + 1] = arc
+            i += 1
+        for segment, following in zip(segments, segments[1:]):
+            segment.stop = not self._compatible(segment, following)
+        return segments
+
+    def _blend(self, before, turn, after):
+        """Shortens the straights either side of the turn and returns the arc
+        to replace it with, or None if the corner can't be cut."""
+        if not (isinstance(before, Distance) and isinstance(after, Distance)
+                and isinstance(turn, Rotation) and turn.pivot == CENTER
+                and before.reverse == after.reverse
+                and 0 < turn.degree <= BLEND_MAX_ANGLE):
+            return None
+        half_angle = math.radians(turn.degree) / 2
+        cut = min(before.meters, after.meters) / 2.0
+        radius = min(BLEND_RADIUS, cut / math.tan(half_angle))
+        if radius < WHEEL_SPAN / 2:
+            return None
+        cut = radius * math.tan(half_angle)
+        before.meters = before.amount = before.meters - cut
+        after.meters = after.amount = after.meters - cut
+        degree = turn.degree if isinstance(turn, Right) else -turn.degree
+        meters = radius * 2 * half_angle
+        return Arc(-meters if before.reverse else meters, degree,
+                   min(before.speed, after.speed))
+
+    def _compatible(self, segment, following):
+        """True if no wheel changes direction between the two segments."""
+        return all(a * b >= 0 for a, b in zip(segment.directions(),
+                                              following.directions()))
+
+    def odometry(self, io):
+        return sum((segment.odometry(io) for segment in self.segments), [])
+
+    def action(self, io):
+        try:
+            for segment in self.segments:
+                if io.held_by(segment):
+                    self.stop_motors(io) # the last segment may not have
+                    io.hold(segment)
+                segment.action(io)
+        finally:
+            if self.amount > 0:
+                self.completed = sum(self._length(segment) * segment.completed
+                                     for segment in self.segments) / self.amount
+            else:
+                self.completed = float(all(segment.completed == 1.0
+                                           for segment in self.segments))
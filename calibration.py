@@ -0,0 +1,274 @@
+"""
+    This file is part of Team Brocket Robotics, licensed under the MIT License.
+    A copy of the MIT License can be found in LICENSE.txt
+"""
+
+"""
+Motor speed calibration. A sweep drives the robot at a range of speeds,
+measures how far each wheel went by watching a marker, and fits a speed to RPM
+curve per wheel. The curves are kept on the USB key and used by
+MotorController in place of the single RPM figure in MOTOR_RPM. How far the
+drives stray from the curves is kept with them, as the odometry noise the pose
+tracker expects.
+"""
+
+import os
+import json
+import math
+import logging
+
+from vision_controller import Marker
+
+FILENAME = 'calibration.json'
+SWEEP_SPEEDS = (12, 20, 30, 45, 60, 80, 100)
+SWEEP_TIME = 90.0 # seconds * % speed driven for each sample, at most 6s
+TABLE_STEP = 5 # % speed between the points of a fitted table
+AHEAD_TRIES = 5 # captures looking for a marker before giving up
+NOISE_KEY = 'odometry' # of the odometry noise in the calibration file
+MIN_NOISE_DRIVES = 3 # sweep drives needed to measure a noise figure
+# Odometry standard deviations until a sweep measures them, on the wide side
+# as the pose tracker trusts its pose less the bigger they are
+ODOMETRY_NOISE = {
+    'distance': 0.15, # per meter driven
+    'turn': 0.1, # per radian turned, the sweep doesn't turn
+    'drift': math.radians(8), # radians of heading per meter driven forwards
+    'reverse_drift': math.radians(20), # per meter backwards
+}
+
+class CalibrationTable(object):
+    """Speed to RPM lookup, linearly interpolated between points."""
+
+    def __init__(self, points):
+        self.points = sorted((float(s), float(r)) for s, r in points)
+        if len(self.points) < 2:
+            raise ValueError("A calibration table needs at least 2 points")
+
+    def rpm(self, speed):
+        return self._lookup(self.points, abs(speed))
+
+    def speed(self, rpm):
+        """Returns the % speed giving the RPM, the inverse of rpm()."""
+        inverse = [(r, s) for s, r in self.points]
+        moving = [p for p in inverse if p[0] > 0]
+        if moving and abs(rpm) > 0:
+            # The last speed at 0 RPM is where the wheel starts to move
+            still = [p for p in inverse if p[0] <= 0]
+            inverse = still[-1:] + moving
+        return self._lookup(inverse, abs(rpm))
+
+    @staticmethod
+    def _lookup(points, x):
+        if x <= points[0][0]:
+            lo, hi = points[0], points[1]
+        elif x >= points[-1][0]:
+            lo, hi = points[-2], points[-1]
+        else:
+            for hi in points:
+                if hi[0] >= x:
+                    break
+                lo = hi
+        if hi[0] == lo[0]:
+            return lo[1]
+        return lo[1] + (hi[1] - lo[1]) * (x - lo[0]) / (hi[0] - lo[0])
+
+    def to_list(self):
+        return [list(point) for point in self.points]
+
+def fit(samples, step=TABLE_STEP):
+    """Least squares fit of rpm = a + b * speed + c * speed^2 to the
+    (speed, rpm) samples. Returns the CalibrationTable of the curve from 0 to
+    100% speed, never negative and never decreasing. Below the slowest sample
+    the curve carries on in a straight line, so the dead band shows up."""
+    if len(set(s for s, r in samples)) < 3:
+        raise ValueError("Need samples at 3 or more speeds to fit a curve")
+    sums = [sum(float(s) ** n for s, r in samples) for n in range(5)]
+    rhs = [sum(float(s) ** n * r for s, r in samples) for n in range(3)]
+    matrix = [[sums[i + j] for j in range(3)] + [rhs[i]] for i in range(3)]
+    a, b, c = _solve(matrix)
+    slowest = float(min(s for s, r in samples))
+    low_rpm = a + b * slowest + c * slowest ** 2
+    low_slope = b + 2 * c * slowest
+    points = []
+    highest = 0.0
+    for speed in range(0, 101, step):
+        if speed < slowest:
+            rpm = low_rpm + low_slope * (speed - slowest)
+        else:
+            rpm = a + b * speed + c * speed ** 2
+        highest = max(highest, rpm)
+        points.append((speed, highest))
+    return CalibrationTable(points)
+
+def _solve(matrix):
+    """Gaussian elimination of an augmented n x (n + 1) matrix."""
+    n = len(matrix)
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda row: abs(matrix[row][col]))
+        matrix[col], matrix[pivot] = matrix[pivot], matrix[col]
+        if matrix[col][col] == 0:
+            raise ValueError("Calibration samples are degenerate")
+        for row in range(col + 1, n):
+            factor = matrix[row][col] / matrix[col][col]
+            for k in range(col, n + 1):
+                matrix[row][k] -= factor * matrix[col][k]
+    result = [0.0] * n
+    for row in reversed(range(n)):
+        total = sum(matrix[row][k] * result[k] for k in range(row + 1, n))
+        result[row] = (matrix[row][n] - total) / matrix[row][row]
+    return result
+
+def wheel_travel(before, after, span):
+    """Returns the (left, right) meters the wheels moved, given the same
+    marker seen before and after a near straight drive."""
+    def position(marker):
+        # Robot frame, x ahead and y to the left
+        dist = Marker(marker).horizontal_dist
+        angle = math.radians(marker.rot_y)
+        return dist * math.cos(angle), -dist * math.sin(angle)
+    x0, y0 = position(before)
+    x1, y1 = position(after)
+    def moved(heading):
+        # Where the robot must have gone to turn by heading (counter clockwise)
+        cos, sin = math.cos(heading), math.sin(heading)
+        return x0 - (cos * x1 - sin * y1), y0 - (sin * x1 + cos * y1)
+    def error(heading):
+        # It moved along the mean heading of the drive
+        px, py = moved(heading)
+        return math.sin(heading / 2) * px - math.cos(heading / 2) * py
+    h0, h1 = 0.0, 0.01
+    e0, e1 = error(h0), error(h1)
+    for i in range(20):
+        if e1 == e0 or abs(e1) < 1e-9:
+            break
+        h0, h1 = h1, h1 - e1 * (h1 - h0) / (e1 - e0)
+        e0, e1 = e1, error(h1)
+    px, py = moved(h1)
+    mean = math.cos(h1 / 2) * px + math.sin(h1 / 2) * py
+    return mean - h1 * span / 2, mean + h1 * span / 2
+
+def sweep(io, speeds=SWEEP_SPEEDS, run=SWEEP_TIME):
+    """Drive forward then back at each speed while watching the marker
+    ahead. Returns the {wheel id: [(speed, rpm)]} samples and the drives as
+    [(speed, seconds, left meters, right meters)], backwards negative."""
+    from IOInterface import WHEEL_SPAN
+    log = logging.getLogger('Robot.Calibration')
+    wheels = {'LEFT': io.left_wheel, 'RIGHT': io.right_wheel}
+    samples = dict((id, []) for id in wheels)
+    drives = []
+    for speed in speeds:
+        seconds = min(6.0, run / speed)
+        for direction in (1, -1):
+            before = _ahead(io)
+            if before is None:
+                log.warning("No marker ahead, skipping speed %d", speed)
+                continue
+            for wheel in wheels.values():
+                if direction > 0:
+                    wheel.forward(speed)
+                else:
+                    wheel.backward(speed)
+            io.wait(seconds)
+            for wheel in wheels.values():
+                wheel.stop()
+            io.wait(0.5) # let the robot settle before looking again
+            after = _ahead(io, before.info.code)
+            if after is None:
+                log.warning("Lost marker %d at speed %d", before.info.code,
+                            speed)
+                continue
+            travel = wheel_travel(before, after, WHEEL_SPAN)
+            drives.append((speed, seconds) + travel)
+            for (id, wheel), dist in zip(sorted(wheels.items()), travel):
+                rpm = (60.0 * abs(dist)) / (wheel.get_circumference() * seconds)
+                samples[id].append((speed, rpm))
+                log.info("%s wheel at %d%%: %.3fm, %.1f RPM", id, speed, dist,
+                         rpm)
+    return samples, drives
+
+def odometry_fit(drives, left, right, circumference, span):
+    """Returns the odometry noise of the sweep drives against the fitted
+    left and right tables: the spread of the distance driven about the
+    tables and the heading lost per meter either way. The figures with too
+    few drives to go on keep their ODOMETRY_NOISE default."""
+    errors = []
+    drifts = {'drift': [], 'reverse_drift': []}
+    for speed, seconds, left_dist, right_dist in drives:
+        rpm = (left.rpm(speed) + right.rpm(speed)) / 2.0
+        expected = rpm * circumference * seconds / 60.0
+        meters = (left_dist + right_dist) / 2.0
+        if expected <= 0 or meters == 0:
+            continue
+        errors.append(abs(meters) / expected - 1)
+        turned = (right_dist - left_dist) / span
+        drifts['drift' if meters > 0 else 'reverse_drift'].append(
+            turned / abs(meters))
+    noise = dict(ODOMETRY_NOISE)
+    for name, values in [('distance', errors)] + drifts.items():
+        if len(values) >= MIN_NOISE_DRIVES:
+            noise[name] = math.sqrt(sum(v ** 2 for v in values) / len(values))
+    return noise
+
+def _ahead(io, code=None, tries=AHEAD_TRIES):
+    """Returns the marker nearest straight ahead, or the one with the given
+    code, None if none is seen in tries captures."""
+    for i in range(tries):
+        markers = io.get_markers(fresh=True)
+        if code is not None:
+            markers = markers.by_code(code)
+        if len(markers) > 0:
+            return io.get_closest_marker_rotation(markers)
+    return None
+
+def calibrate(io, root, type='wheel'):
+    """Run a sweep, fit the tables and the odometry noise and save them to
+    the calibration file in root. The wheels use the new tables straight
+    away, the pose tracker the noise from the next start_tracking."""
+    from IOInterface import WHEEL_SPAN
+    samples, drives = sweep(io)
+    tables = dict(('%s.%s' % (type, id), fit(points))
+                  for id, points in samples.items())
+    io.left_wheel.calibration = tables['%s.LEFT' % type]
+    io.right_wheel.calibration = tables['%s.RIGHT' % type]
+    noise = odometry_fit(drives, io.left_wheel.calibration,
+                         io.right_wheel.calibration,
+                         io.left_wheel.get_circumference(), WHEEL_SPAN)
+    save(os.path.join(root, FILENAME), tables, noise)
+    return tables
+
+_tables = {}
+_noise = {}
+
+def table_for(type, id):
+    """Returns the loaded CalibrationTable for the motor or None."""
+    return _tables.get('%s.%s' % (type, id))
+
+def odometry_noise():
+    """Returns the loaded odometry noise, the defaults for any not saved."""
+    noise = dict(ODOMETRY_NOISE)
+    noise.update(_noise)
+    return noise
+
+def load(path):
+    """Load the tables and odometry noise saved at path, if there is a file
+    there. Returns the tables."""
+    global _tables, _noise
+    if os.path.isdir(path):
+        path = os.path.join(path, FILENAME)
+    if not os.path.exists(path):
+        _tables, _noise = {}, {}
+        return _tables
+    with open(path) as f:
+        data = json.load(f)
+    _noise = data.pop(NOISE_KEY, {})
+    _tables = dict((key, CalibrationTable(points))
+                   for key, points in data.items())
+    return _tables
+
+def save(path, tables, noise=None):
+    global _tables, _noise
+    data = dict((key, table.to_list()) for key, table in tables.items())
+    if noise is not None:
+        data[NOISE_KEY] = noise
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    _tables, _noise = dict(tables), dict(noise or {})
@@ -0,0 +1,99 @@
+"""
+    This file is part of Team Brocket Robotics, licensed under the MIT License.
+    A copy of the MIT License can be found in LICENSE.txt
+"""
+
+"""
+Clock service used wherever the robot code sleeps or takes a timestamp.
+The real clock is used on the robot, the virtual clock lets the simulator and
+replays run as fast as the CPU allows.
+"""
+
+import time as _time
+import threading
+
+class RealClock(object):
+    def time(self):
+        return _time.time()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            _time.sleep(seconds)
+
+    def wait(self, event, seconds):
+        """Sleep until the event is set or the time is up, returns True if
+        the event was set."""
+        return event.wait(max(0, seconds))
+
+    def __repr__(self):
+        return "<RealClock>"
+
+class VirtualClock(object):
+    """Step driven clock, sleeping advances the time instantly."""
+
+    def __init__(self, start=0.0):
+        self.now = float(start)
+        self._lock = threading.Lock()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def wait(self, event, seconds):
+        if event.is_set():
+            return True
+        self.advance(seconds)
+        return event.is_set()
+
+    def advance(self, seconds):
+        with self._lock:
+            self.now += max(0, seconds)
+
+    def __repr__(self):
+        return "<VirtualClock %.3f>" % self.now
+
+class ScaledClock(object):
+    """Real clock running factor times faster than wall time."""
+
+    def __init__(self, factor):
+        if factor <= 0:
+            raise ValueError("Clock factor must be positive")
+        self.factor = float(factor)
+        self._start = _time.time()
+
+    def time(self):
+        return self._start + (_time.time() - self._start) * self.factor
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            _time.sleep(seconds / self.factor)
+
+    def wait(self, event, seconds):
+        return event.wait(max(0, seconds) / self.factor)
+
+    def __repr__(self):
+        return "<ScaledClock x%.1f>" % self.factor
+
+_clock = RealClock()
+
+def get_clock():
+    return _clock
+
+def set_clock(new_clock):
+    """Replace the clock used by all modules, returns the previous one."""
+    global _clock
+    if not hasattr(new_clock, 'time') or not hasattr(new_clock, 'sleep'):
+        raise TypeError("Invalid clock %r" % new_clock)
+    old, _clock = _clock, new_clock
+    return old
+
+def time():
+    return _clock.time()
+
+def sleep(seconds):
+    _clock.sleep(seconds)
+
+def wait(event, seconds):
+    return _clock.wait(event, seconds)
@@ -0,0 +1,76 @@
+/*
+    This file is part of Team Brocket Robotics, licensed under the MIT License.
+    A copy of the MIT License can be found in LICENSE.txt
+
+    SR Ruggeduino firmware with the bulk read extension.
+
+    Speaks the same serial protocol as the stock SR firmware: a command
+    character, then the pin as 'a' + pin number, and every command is answered
+    with one line.
+        i, o, p   pin mode INPUT, OUTPUT, INPUT_PULLUP
+        r         digital read, answers h or l
+        l, h      digital write low or high
+        a         analogue read, answers the 0-1023 value
+        v         version, answers SRduino:<version>
+    Added:
+        R         read every digital pin, answers the hex bitmask of the pin
+                  levels (bit n is pin n). The version carries the "bulk" tag
+                  so the robot knows it can use it.
+*/
+
+#define FW_VERSION "1-bulk"
+#define DIGITAL_PINS 14
+
+void setup() {
+  Serial.begin(115200);
+}
+
+int read_pin() {
+  while (!Serial.available());
+  return Serial.read() - 'a';
+}
+
+void loop() {
+  if (!Serial.available()) {
+    return;
+  }
+  int pin;
+  char command = Serial.read();
+  switch (command) {
+    case 'i':
+      pinMode(read_pin(), INPUT);
+      break;
+    case 'o':
+      pinMode(read_pin(), OUTPUT);
+      break;
+    case 'p':
+      pinMode(read_pin(), INPUT_PULLUP);
+      break;
+    case 'r':
+      Serial.print(digitalRead(read_pin()) == HIGH ? 'h' : 'l');
+      break;
+    case 'l':
+      digitalWrite(read_pin(), LOW);
+      break;
+    case 'h':
+      digitalWrite(read_pin(), HIGH);
+      break;
+    case 'a':
+      pin = read_pin();
+      Serial.print(analogRead(pin));
+      break;
+    case 'v':
+      Serial.print("SRduino:");
+      Serial.print(FW_VERSION);
+      break;
+    case 'R': {
+      // Read the port registers directly so all pins are sampled together
+      unsigned int mask = PIND | ((unsigned int)(PINB & 0x3f) << 8);
+      Serial.print(mask, HEX);
+      break;
+    }
+    default:
+      return;
+  }
+  Serial.print("\n");
+}
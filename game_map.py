@@ -3,6 +3,62 @@
     A copy of the MIT License can be found in LICENSE.txt
 """
 
+"""
+Arena layout. World coordinates are in meters with corner 0 at the origin,
+x along the wall with arena markers 0-6 and y along the wall with 27-21.
+Headings are degrees anticlockwise from the x axis.
+"""
+
+import math
+
+ARENA_SIZE = 8.0
+# Wall n runs anticlockwise with codes 7n to 7n + 6 spaced 1m apart:
+# (start, step along the wall, heading the markers face)
+WALLS = [((0, 0), (1, 0), 90), ((8, 0), (0, 1), 180),
+         ((8, 8), (-1, 0), -90), ((0, 8), (0, -1), 0)]
+# Slot platform in the middle of the arena, slots face outwards
+PLATFORM = (2.0, 3.4, 6.0, 4.6)  # x1, y1, x2, y2
+SLOTS = {32: (2.5, 3.4, -90), 33: (3.5, 3.4, -90), 34: (4.5, 3.4, -90),
+         35: (5.5, 3.4, -90), 36: (5.5, 4.6, 90), 37: (4.5, 4.6, 90),
+         38: (3.5, 4.6, 90), 39: (2.5, 4.6, 90)}
+
+def _wall_markers():
+    markers = {}
+    for n, (start, step, facing) in enumerate(WALLS):
+        for i in range(7):
+            markers[7 * n + i] = (start[0] + step[0] * (i + 1),
+                                  start[1] + step[1] * (i + 1), facing)
+    return markers
+
+# Arena marker code: (x, y, heading it faces)
+ARENA_MARKERS = _wall_markers()
+# Where the robot starts in corner 0, facing the middle of the arena
+START_POSE = (0.6, 0.6, 45)
+
+def corner_transform(corner, x, y, heading=0):
+    """Map a position and heading from the frame of corner 0 into the frame
+    of the given corner. Corner 0 is (0, 0), corner 3 is (8, 0), corner 2 is
+    (8, 8) and corner 1 is (0, 8)."""
+    if corner == 1:
+        return x, ARENA_SIZE - y, -heading
+    if corner == 2:
+        return ARENA_SIZE - x, ARENA_SIZE - y, heading + 180
+    if corner == 3:
+        return ARENA_SIZE - x, y, 180 - heading
+    return x, y, heading
+
+def start_pose(corner):
+    return corner_transform(corner, *START_POSE)
+
+def slot_approach(code, distance):
+    """Returns the (x, y, heading) distance meters out from the slot, facing
+    it."""
+    x, y, facing = SLOTS[code]
+    angle = math.radians(facing)
+    heading = (facing + 360) % 360 - 180
+    return x + distance * math.cos(angle), y + distance * math.sin(angle), \
+        heading
+
 def get_our_tokens(corner):
     codes = range(40 + corner, 49 + corner, 4)
     return codes
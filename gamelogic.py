@@ -4,16 +4,41 @@
 """
 
 from IOInterface import *
+from vision_controller import MARKER_TOKEN_BOTTOM
 from state_utils import StateMachine, StateInterrupt
+from watchers import WorldModel
+import pose
 import game_map
 
+NEAR_OBSTACLES = MarkerQuery('ROBOTS', 'WALLS').dist(high=0.5)
+SLOTS_AHEAD = MarkerQuery('SLOTS').rot_y(high=5)
+WALLS = MarkerQuery('WALLS')
+MATCH_TIME = 180 # seconds
+SLOT_APPROACH = 0.8 # meters out from the slot to drive to when the pose is known
+TOKEN_VIEW = 2.0 # meters, drive nearer to a remembered token than this
+
+# State: the states it can change to
+TRANSITIONS = {"START": ["SEARCH_SLOT"],
+               "SEARCH_SLOT": ["DRIVE_TO_SLOT"],
+               "DRIVE_TO_SLOT": ["PLACE_TOKEN", "SEARCH_SLOT"],
+               "PLACE_TOKEN": ["TURN_TO_TOKEN"],
+               "TURN_TO_TOKEN": ["SEARCH_TOKEN"],
+               "SEARCH_TOKEN": ["DRIVE_TO_TOKEN", "SEARCH_TOKEN"],
+               "DRIVE_TO_TOKEN": ["PICK_TOKEN", "SEARCH_TOKEN"],
+               "PICK_TOKEN": ["TURN_TO_SLOT"],
+               "TURN_TO_SLOT": ["SEARCH_SLOT", "SEARCH_TOKEN"]}
+
 class PlayGame:
-    def __init__(self, log, io, corner):
+    def __init__(self, log, io, corner, match_start=None):
         self.log = log
         self.io = io
         self.our_tokens = game_map.get_our_tokens(corner)
         self.log.info("Token codes for this match: %s", str(self.our_tokens))
+        self.our_token_query = MarkerQuery('TOKENS').codes(self.our_tokens)
+        self.held_token_query = MarkerQuery().types(MARKER_TOKEN_BOTTOM).codes(
+            self.our_tokens).dist(high=0.5)
         self.corner = corner
+        self.match_start = match_start
         self.startup()
 
     def AdjDir(self, Dir):
@@ -31,21 +56,40 @@ class PlayGame:
                                    "SEARCH_TOKEN": self.search_token,
                                    "DRIVE_TO_TOKEN": self.drive_to_token,
                                    "PICK_TOKEN": self.pickup_token,
-                                   "TURN_TO_SLOT": self.next_slot})
+                                   "TURN_TO_SLOT": self.next_slot},
+                                  TRANSITIONS,
+                                  # State: (seconds, state when they run out)
+                                  {"START": (25, "SEARCH_SLOT"),
+                                   "SEARCH_SLOT": (40, "PLACE_TOKEN"),
+                                   "DRIVE_TO_SLOT": (25, "PLACE_TOKEN"),
+                                   "PLACE_TOKEN": (10, "TURN_TO_TOKEN"),
+                                   "TURN_TO_TOKEN": (15, "SEARCH_TOKEN"),
+                                   "SEARCH_TOKEN": (45, "SEARCH_TOKEN"),
+                                   "DRIVE_TO_TOKEN": (25, "SEARCH_TOKEN"),
+                                   "PICK_TOKEN": (10, "TURN_TO_SLOT"),
+                                   "TURN_TO_SLOT": (25, self.search_next)})
 
         self.state.bind('change', self.state_changed)
         self.state.bind('error', self.state_error)
         self.state.bind('finish', self.state_finished)
         self.state.bind('interrupt', self.state_interrupted)
+        self.state.bind('timeout', self.state_timeout)
         self.on_interrupt = None
+        self.io.deadline = self.state.deadline
+        self.state.start_match(MATCH_TIME, self.match_start)
         self.reset()
-        for state in self.state.next_state():
-            self.state.change_state(state)
+        try:
+            for state in self.state.next_state():
+                self.state.change_state(state)
+            self.log.info("State machine ended")
+        finally:
+            self.state.report(self.log)
 
     def set_state(self, state, *args):
         self.state.set_state(state, args)
     def state_changed(self, fromstate, tostate):
         self.log.info("State Changed from %s to %s", fromstate, tostate)
+        self.io.log_stats()
     def state_error(self, state, errors):
         self.log.error(str(state) + " encountered errors")
         for e in errors:
@@ -58,9 +102,21 @@ class PlayGame:
             self.on_interrupt()
             self.on_interrupt = None
 
+    def state_timeout(self, state, fallback):
+        if fallback is None:
+            self.log.warning("Out of time in %s", state)
+        else:
+            self.log.warning("%s ran out of time, falling back to %s", state,
+                             fallback)
+
+    def search_next(self):
+        return "SEARCH_SLOT" if self.has_token else "SEARCH_TOKEN"
+
     def reset(self):
         self.io.set_bump_handler(self.onbump)
         self.io.set_marker_handler(self.handle_markers)
+        self.io.start_tracking(*game_map.start_pose(self.corner))
+        self.world = WorldModel(lambda: self.io.where(TRACK_ERROR))
         self.io.open_grabber()
         self.io.move_arm(DOWN, True)
         self.has_token = False
@@ -73,53 +129,58 @@ class PlayGame:
         self.log.info(bump)
 
     def handle_markers(self, markers):
+        self.world.update(markers)
         currstate = self.state.get_active_state().name
-        obsticles = MarkerFilter.include('ROBOTS', 'WALLS')
-        for marker in markers:
-            if marker.info.marker_type in obsticles:
-                if marker.dist < 0.5:
-                    def after_interrupt():
-                        self.log.info("Move away")
-                        self.io.drive(Distance(-0.9, 50))
-                        self.io.turn(Right(10, Speed(50)))
-                    self.on_interrupt = after_interrupt
-                    self.log.info("Obsticle found, %s", str(marker))
-                    self.io._stop_operation()
-            if marker.info.marker_type in MarkerFilter.include('SLOTS'):
-                if currstate == "SEARCH_TOKEN" and marker.rot_y < 5:
-                    self.log.info("Found slot while searching for token")
-                    def itrpt():
-                        self.io.turn(Right(90, Speed(50)))
-                        self.set_state("SEARCH_TOKEN")
-                    self.on_interrupt = itrpt()
-                    raise StateInterrupt('slotfound', [])
-            if marker.info.marker_type in MarkerFilter.include("WALLS"):
-                if currstate == "SEARCH_TOKEN":
-                    self.log.info("Check walls here")
-                    
-                    # check looking at correct wall
-                    continue
-                    #game_map.get_arena_codes_for_corner(self.corner)
+        for marker in NEAR_OBSTACLES.all(markers):
+            # The planner has a robot seen while navigating and steers around
+            # it when the state goes on, otherwise turn away from it
+            def after_interrupt(around=marker.info.marker_type == MARKER_ROBOT
+                                and self.io.navigating):
+                self.log.info("Move away")
+                self.io.drive(Distance(-0.9, 50))
+                if not around:
+                    self.io.turn(Right(10, Speed(50)))
+            self.on_interrupt = after_interrupt
+            self.log.info("Obsticle found, %s", str(marker))
+            self.io._stop_operation()
+        if currstate == "SEARCH_TOKEN":
+            for marker in SLOTS_AHEAD.all(markers):
+                self.log.info("Found slot while searching for token")
+                def itrpt():
+                    self.io.turn(Right(90, Speed(50)))
+                    self.set_state("SEARCH_TOKEN")
+                self.on_interrupt = itrpt()
+                raise StateInterrupt('slotfound', [])
+            if WALLS.any(markers):
+                self.log.info("Check walls here")
+                # check looking at correct wall
+                #game_map.get_arena_codes_for_corner(self.corner)
 
     def preset_start(self):
         self.from_start = True
         self.log.info("Grabbing token")
         self.io.close_grabber(True)
-        self.io.move_arm(UP, True)
+        lift = self.io.move_arm(UP) # lift while driving off
         self.has_token = True
         self.log.info("Drive 2.3 meters")
         self.io.drive(Distance(2.3, 80))
-        self.io.move_arm(MIDDLE, True)
+        self.io.join(lift)
+        self.io.move_arm(MIDDLE) # lower while turning
         self.io.turn(self.AdjDir(Left)(40, Speed(60)))
+        self.io.join()
         self.set_state("SEARCH_SLOT")
 
     def search_slot(self):
         def filt(markers):
             if not self.from_start: return markers
-            for marker in markers:
-                if marker.info.code == game_map.closest_slot(self.corner):
-                    return [marker]
+            for marker in markers.by_code(game_map.closest_slot(self.corner)):
+                return [marker]
             return markers
+        tracked = self.io.where(TRACK_ERROR)
+        if tracked is not None:
+            x, y, facing = game_map.SLOTS[game_map.closest_slot(self.corner)]
+            self.log.info("Face the slot from %s", str(tracked))
+            self.io.turn_to(x, y, tracked)
         self.search_func("SLOTS", self.AdjDir(Right), "DRIVE_TO_SLOT", max_rot=270,
                          rot_cb=lambda:self.io.drive(Distance(0.5, 50)), filt=filt)
 
@@ -150,6 +211,7 @@ class PlayGame:
 
     def drive_to_slot(self, slot):
         assert self.has_token
+        self.io.move_arm(UP) # lift while driving up, joined in place_token
         if self.io.goto_marker(slot, 70, offset=0.3): #navigate_to_marker
             self.log.info("Got to slot")
             self.set_state("PLACE_TOKEN")
@@ -169,6 +231,8 @@ class PlayGame:
         self.from_start = False
         self.searches["SLOTS"] = 0
         self.io.move_arm(UP, True)
+        # Let go and lower while reversing away, forward drives wait for the
+        # grabber
         self.io.open_grabber()
         self.io.move_arm(DOWN)
         self.has_token = False
@@ -177,6 +241,8 @@ class PlayGame:
 
     def next_token(self):
         self.log.info("Head to next token")
+        # These turns are too sharp to cut with an arc and reverse a wheel, as
+        # a Path they would stop at every corner all the same
         self.io.drive(Distance(-0.7, 60)) # reverse out of zone
         if self.done_count < 2:
             self.log.info("Turn face near token")
@@ -190,9 +256,29 @@ class PlayGame:
 
     def search_token(self):
         def check(tokens):
-            return filter(lambda m:m.info.code in self.our_tokens, tokens)
+            return self.our_token_query.all(tokens)
+        self.recall_token()
         self.search_func("TOKENS", self.AdjDir(Left), "DRIVE_TO_TOKEN", filt=check)
 
+    def recall_token(self):
+        """Face the nearest of our tokens seen before, driving nearer first if
+        it is far, so the search starts looking at it."""
+        position = self.io.where(TRACK_ERROR)
+        if position is None:
+            return
+        token = self.world.closest_token(self.our_tokens, position.x,
+                                         position.y)
+        if token is None:
+            return
+        self.log.info("Remembered %s", token)
+        meters, turn = pose.course_to(position, token.x, token.y)
+        if meters > TOKEN_VIEW:
+            x = token.x + (position.x - token.x) * TOKEN_VIEW / meters
+            y = token.y + (position.y - token.y) * TOKEN_VIEW / meters
+            if not self.io.navigate_to(x, y, 65):
+                return
+        self.io.turn_to(token.x, token.y)
+
     def drive_to_token(self, token):
         assert not self.has_token
         result = self.io.goto_marker(token, 70) #navigate_to_marker
@@ -214,14 +300,19 @@ class PlayGame:
             self.log.info("Holding token")
         self.io.close_grabber(True)
         self.log.info("Pull token out")
-        self.io.move_arm(MIDDLE, True)
+        lift = self.io.move_arm(MIDDLE) # lift while reversing
         self.io.drive(Distance(-0.2, 50))
-        self.io.move_arm(UP, True)
+        self.io.join(lift)
+        self.io.move_arm(UP) # joined in next_slot before looking at the token
         self.has_token = True
         self.set_state("TURN_TO_SLOT")
 
     def next_slot(self):
         self.io.drive(Distance(-0.5, 50)) # Carry token out further
+        self.io.join() # the arm has to be still to see the token
+        # navigate_to needs the pose from a full resolution frame anyway, the
+        # token check is then served from the same frame
+        self.io.get_pose()
         if not self.check_has_token():
             self.log.warning("Dont have token")
             self.io.move_arm(DOWN)
@@ -231,7 +322,11 @@ class PlayGame:
             self.set_state("SEARCH_TOKEN")
             return
         self.log.info("Has token")
-        if self.done_count < 2:
+        x, y, heading = game_map.slot_approach(
+            game_map.closest_slot(self.corner), SLOT_APPROACH)
+        if self.io.navigate_to(x, y, 50, heading):
+            self.log.info("Drove to the slot around the obstacles")
+        elif self.done_count < 2:
             self.io.turn(self.AdjDir(Left)(133, Speed(50)))
             self.io.drive(Distance(2.1, 50))
             self.io.turn(self.AdjDir(Left)(46, Speed(50)))
@@ -241,10 +336,9 @@ class PlayGame:
         self.set_state("SEARCH_SLOT")
 
     def check_has_token(self):
-        tokens = self.io.get_markers([MarkerFilter.include("TOKENS")[1]])
-        tokens = filter(lambda m:m.info.code in self.our_tokens, tokens)
-        tokens = filter(lambda m:m.dist < 0.5, tokens)
-        has_token = len(tokens)
+        self.io.join() # the arm has to be still to see the token
+        tokens = self.io.get_markers(distance=0.5)
+        has_token = self.held_token_query.any(tokens)
         has_token = has_token or self.io.is_holding_token()
         return has_token
 
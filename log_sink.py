@@ -0,0 +1,122 @@
+"""
+    This file is part of Team Brocket Robotics, licensed under the MIT License.
+    A copy of the MIT License can be found in LICENSE.txt
+"""
+
+"""
+Logging that never blocks the control thread. Records are queued and written
+by a background thread, which also does the message formatting.
+"""
+
+import time
+import Queue
+import logging
+import threading
+
+_STOP = object()
+
+class AsyncHandler(logging.Handler):
+    """Queues records for the target stream handler. The records are
+    formatted and written on a writer thread, which flushes the stream at most
+    every flush_interval seconds. When the queue is full records are dropped
+    and counted rather than waited for."""
+
+    def __init__(self, target, max_queue=2000, batch_size=100,
+                 flush_interval=0.5):
+        logging.Handler.__init__(self, target.level)
+        self.target = target
+        self.queue = Queue.Queue(max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._reported = 0
+        self._writer = threading.Thread(target=self._write_loop,
+                                        name="log_writer")
+        self._writer.daemon = True
+        self._writer.start()
+
+    def setLevel(self, level):
+        logging.Handler.setLevel(self, level)
+        self.target.setLevel(level)
+
+    def setFormatter(self, fmt):
+        self.target.setFormatter(fmt)
+
+    def emit(self, record):
+        # Exception info has to be captured now, the traceback goes stale
+        if record.exc_info and not record.exc_text:
+            formatter = self.target.formatter or logging.Formatter()
+            record.exc_text = formatter.formatException(record.exc_info)
+            record.exc_info = None
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _write_loop(self):
+        last_flush = time.time()
+        pending = 0
+        while True:
+            try:
+                if pending:
+                    wait = self.flush_interval - (time.time() - last_flush)
+                    record = self.queue.get(True, max(0.01, wait))
+                else:
+                    record = self.queue.get()
+            except Queue.Empty:
+                record = None
+            batch = [] if record is None else [record]
+            while 0 < len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            stop = _STOP in batch
+            for record in batch:
+                if record is not _STOP:
+                    self._write(record)
+                    pending += 1
+            if self.dropped != self._reported:
+                self._write_line("[%d log records dropped]" %
+                                 (self.dropped - self._reported))
+                self._reported = self.dropped
+            if pending and (stop or pending >= self.batch_size or
+                            time.time() - last_flush >= self.flush_interval):
+                self._flush_target()
+                pending = 0
+                last_flush = time.time()
+            if stop:
+                return
+
+    def _write(self, record):
+        try:
+            self._write_line(self.target.format(record))
+        except Exception:
+            self.target.handleError(record)
+
+    def _write_line(self, line):
+        self.target.stream.write(line + "\n")
+
+    def _flush_target(self):
+        try:
+            self.target.flush()
+        except Exception:
+            pass
+
+    def close(self):
+        if self._writer.is_alive():
+            self.queue.put(_STOP)
+            self._writer.join(5)
+        self.target.close()
+        logging.Handler.close(self)
+
+class lazy(object):
+    """Log argument that calls func(*args) only when the message is formatted,
+    so it costs nothing when the level is off."""
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
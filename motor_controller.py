@@ -5,6 +5,8 @@
 
 import math
 
+import calibration
+
 MOTOR_RPM = {  # model: RPM
     '919D1481': 87, # Quoted value = 106
     '918D151': 2416 # Quoted value = 2416
@@ -35,6 +37,8 @@ class MotorController(object):
         self.RPM = MOTOR_RPM[map[0]] + map[2][id]['rpmoffset']
         self._motor = self._get_channel(board, channel)
         self.opp_dir = 0
+        # Measured speed to RPM curve, see calibration.py
+        self.calibration = calibration.table_for(type, id)
 
     def _get_channel(self, board, channel):
         if not hasattr(board, 'm%d' % channel):
@@ -60,22 +64,44 @@ class MotorController(object):
         diameter table."""
         return self.diameter * math.pi
 
-    def get_rotations(self, seconds):
+    def get_rpm(self, speed=100):
+        """Return the RPM at d% speed, from the calibration table if there is
+        one, otherwise scaled from the pre-defined RPM table."""
+        if self.calibration is not None:
+            return self.calibration.rpm(speed)
+        return self.RPM * abs(speed) / 100.0
+
+    def get_rotations(self, seconds, speed=100):
         """Return how many rotations would occur in the given seconds
-        using pre-defined RPM table."""
-        return (self.RPM / 60.0) * seconds
+        at d% speed."""
+        return (self.get_rpm(speed) / 60.0) * seconds
 
     def calc_distance(self, time, speed):
         """Calculate the expected distance moved in
         t seconds at d% speed."""
         circumference = self.get_circumference()
-        revolutions = self.get_rotations(time)
-        return circumference * revolutions * (speed / 100.0)
+        revolutions = self.get_rotations(time, speed)
+        return circumference * revolutions
 
     def calc_wait_time(self, dist, speed):
         """Calculate the delay it takes to travel dist at d% speed."""
-        dist, speed = abs(dist), abs(speed)
-        return (6000 * dist) / (self.RPM * self.get_circumference() * speed)
+        if dist == 0:
+            return 0.0
+        rpm = self.get_rpm(speed)
+        if rpm <= 0:
+            # In the dead band of the calibration, the plain RPM figure is a
+            # better guess than not moving at all
+            rpm = self.RPM * abs(speed) / 100.0
+        if rpm <= 0:
+            raise ValueError("Speed %r is too slow to move" % speed)
+        return (60.0 * abs(dist)) / (rpm * self.get_circumference())
+
+    def calc_speed(self, dist, seconds):
+        """Calculate the % speed needed to travel dist in the given seconds."""
+        rpm = (60.0 * abs(dist)) / (self.get_circumference() * seconds)
+        if self.calibration is not None:
+            return self.calibration.speed(rpm)
+        return 100.0 * rpm / self.RPM
 
     def calc_rpm(self, duration, actual_dist, speed):
         """
@@ -0,0 +1,347 @@
+"""
+    This file is part of Team Brocket Robotics, licensed under the MIT License.
+    A copy of the MIT License can be found in LICENSE.txt
+"""
+
+"""
+Path planning over an occupancy grid of the arena. The walls and the slot
+platform are static obstacles, robots that have been seen block the cells
+around them until they have not been seen for a while. The search is D* Lite:
+it runs backwards from the goal, so when the robot moves or cells change only
+the part of the search affected is redone instead of starting over. A repair
+that runs past MAX_REPAIR expansions is given up on and the search started
+again.
+"""
+
+import math
+import heapq
+
+import clock
+import game_map
+
+RESOLUTION = 0.1 # meters per cell
+CLEARANCE = 0.25 # meters kept between the middle of the robot and anything
+ROBOT_RADIUS = 0.3 # meters, size of another robot
+ROBOT_MEMORY = 5.0 # seconds a robot blocks the cells it was seen in
+INFINITY = float('inf')
+# Step costs in tenths of a cell, whole numbers so the keys of the search
+# compare exactly
+STRAIGHT = 10
+DIAGONAL = 14
+NEIGHBOURS = [(dx, dy, DIAGONAL if dx and dy else STRAIGHT)
+              for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy]
+MAX_REPAIR = 1500 # cells a repair may expand before starting again instead
+
+def _octile(dx, dy):
+    """Cost of the shortest step path across dx by dy cells."""
+    dx, dy = abs(dx), abs(dy)
+    return STRAIGHT * max(dx, dy) + (DIAGONAL - STRAIGHT) * min(dx, dy)
+
+class GridPlanner(object):
+    def __init__(self, size=game_map.ARENA_SIZE, resolution=RESOLUTION,
+                 clearance=CLEARANCE):
+        self.resolution = resolution
+        self.clearance = clearance
+        self.cells = int(round(size / resolution))
+        self.static = set()
+        self.robots = {} # code: (x, y, time last seen)
+        self._robot_cells = {} # code: cells it blocks
+        self._dynamic = {} # cell: number of robots blocking it
+        self._add_walls()
+        self._add_box(*game_map.PLATFORM)
+        # The search works on cell numbers, i * cells + j
+        n = self.cells
+        self._coords = [divmod(c, n) for c in range(n * n)]
+        self._adjacent = [[(i * n + j, step) for i, j, step in
+                           [(ci + dx, cj + dy, step)
+                            for dx, dy, step in NEIGHBOURS]
+                           if 0 <= i < n and 0 <= j < n]
+                          for ci, cj in self._coords]
+        self._free = [not self.blocked(cell) for cell in self._coords]
+        self.goal = None
+        self.expanded = 0 # cells expanded by the searches, for profiling
+        self.restarts = 0 # repairs given up on
+
+    def _add_walls(self):
+        edge = int(math.ceil(self.clearance / self.resolution))
+        for i in range(self.cells):
+            for j in range(self.cells):
+                if min(i, j, self.cells - 1 - i, self.cells - 1 - j) < edge:
+                    self.static.add((i, j))
+
+    def _add_box(self, x1, y1, x2, y2):
+        for cell in self._cells_near_box(x1, y1, x2, y2, self.clearance):
+            self.static.add(cell)
+
+    def _cells_near_box(self, x1, y1, x2, y2, margin):
+        lo = self.cell(x1 - margin, y1 - margin)
+        hi = self.cell(x2 + margin, y2 + margin)
+        cells = []
+        for i in range(max(0, lo[0]), min(self.cells, hi[0] + 1)):
+            for j in range(max(0, lo[1]), min(self.cells, hi[1] + 1)):
+                x, y = self.centre((i, j))
+                dx = max(x1 - x, 0, x - x2)
+                dy = max(y1 - y, 0, y - y2)
+                if math.hypot(dx, dy) <= margin:
+                    cells.append((i, j))
+        return cells
+
+    def cell(self, x, y):
+        return int(x / self.resolution), int(y / self.resolution)
+
+    def centre(self, cell):
+        return ((cell[0] + 0.5) * self.resolution,
+                (cell[1] + 0.5) * self.resolution)
+
+    def blocked(self, cell):
+        i, j = cell
+        if not (0 <= i < self.cells and 0 <= j < self.cells):
+            return True
+        return cell in self.static or cell in self._dynamic
+
+    def see_robot(self, code, x, y):
+        """A robot was seen at the arena point, its cells stay blocked for
+        ROBOT_MEMORY seconds after it was last seen."""
+        self.robots[code] = (x, y, clock.time())
+        cells = self._cells_near_box(x, y, x, y,
+                                     ROBOT_RADIUS + self.clearance)
+        old = self._robot_cells.get(code, [])
+        if set(old) != set(cells):
+            self._set_robot_cells(code, cells)
+
+    def forget_robots(self):
+        """Unblock the cells of robots not seen for ROBOT_MEMORY seconds."""
+        now = clock.time()
+        for code, (x, y, seen) in self.robots.items():
+            if now - seen > ROBOT_MEMORY:
+                del self.robots[code]
+                self._set_robot_cells(code, [])
+
+    def _set_robot_cells(self, code, cells):
+        changed = []
+        for cell in self._robot_cells.pop(code, []):
+            self._dynamic[cell] -= 1
+            if not self._dynamic[cell]:
+                del self._dynamic[cell]
+                changed.append(cell)
+        for cell in cells:
+            if cell not in self._dynamic:
+                changed.append(cell)
+            self._dynamic[cell] = self._dynamic.get(cell, 0) + 1
+        if cells:
+            self._robot_cells[code] = cells
+        self._changed(changed)
+
+    # D* Lite, see Koenig and Likhachev, "D* Lite" (AAAI 2002), the optimised
+    # version of figure 4
+
+    def set_goal(self, x, y):
+        """Plan towards the arena point, keeps the search if it is the same
+        goal as before."""
+        goal = self.free_cell(self.cell(x, y))
+        if goal != self.goal:
+            self._restart(goal)
+
+    def _restart(self, goal):
+        self.goal = goal
+        self._goal = goal[0] * self.cells + goal[1]
+        self.g = [INFINITY] * len(self._coords)
+        self.rhs = [INFINITY] * len(self._coords)
+        self.rhs[self._goal] = 0
+        self.queue = []
+        self._queued = {} # cell: key it is queued with
+        self.km = 0
+        self.last = None
+        self.start = None
+        self._enqueue(self._goal)
+
+    def _h(self, a, b):
+        (ai, aj), (bi, bj) = self._coords[a], self._coords[b]
+        return _octile(ai - bi, aj - bj)
+
+    def _key(self, cell):
+        g, rhs = self.g[cell], self.rhs[cell]
+        best = g if g < rhs else rhs
+        if self.start is None:
+            return best + self.km, best
+        # _h inline, this is the hot spot of the search
+        (si, sj), (ci, cj) = self._coords[self.start], self._coords[cell]
+        dx, dy = abs(si - ci), abs(sj - cj)
+        if dx < dy:
+            dx, dy = dy, dx
+        return best + STRAIGHT * dx + (DIAGONAL - STRAIGHT) * dy + self.km, best
+
+    def _enqueue(self, cell):
+        """Queue the cell if it is inconsistent, otherwise take it off the
+        queue. Stale queue entries are skipped when they come up."""
+        g, rhs = self.g[cell], self.rhs[cell]
+        if g != rhs:
+            key = self._key(cell)
+            if self._queued.get(cell) != key:
+                self._queued[cell] = key
+                heapq.heappush(self.queue, (key, cell))
+        else:
+            self._queued.pop(cell, None)
+
+    def _lookahead(self, cell):
+        """The cost to the goal through the best of the cell's neighbours."""
+        if not self._free[cell]:
+            return INFINITY
+        g, free = self.g, self._free
+        best = INFINITY
+        for other, step in self._adjacent[cell]:
+            if free[other] and step + g[other] < best:
+                best = step + g[other]
+        return best
+
+    def _search(self, limit=None):
+        """Expand cells until the start is consistent. Returns False if that
+        took more than limit expansions."""
+        g, rhs, free = self.g, self.rhs, self._free
+        queue, queued, adjacent = self.queue, self._queued, self._adjacent
+        coords, push, pop = self._coords, heapq.heappush, heapq.heappop
+        start, goal, km = self.start, self._goal, self.km
+        si, sj = coords[start]
+        def enqueue(cell):
+            # _enqueue with the key worked out in place, as this runs for
+            # every neighbour of every cell expanded
+            if g[cell] == rhs[cell]:
+                queued.pop(cell, None)
+                return
+            best = g[cell] if g[cell] < rhs[cell] else rhs[cell]
+            ci, cj = coords[cell]
+            dx, dy = abs(si - ci), abs(sj - cj)
+            if dx < dy:
+                dx, dy = dy, dx
+            key = (best + STRAIGHT * dx + (DIAGONAL - STRAIGHT) * dy + km,
+                   best)
+            if queued.get(cell) != key:
+                queued[cell] = key
+                push(queue, (key, cell))
+        expanded = 0
+        while queue:
+            key, cell = queue[0]
+            if queued.get(cell) != key:
+                pop(queue) # stale entry
+                continue
+            if rhs[start] == g[start] and key >= (g[start] + km, g[start]):
+                break # the key of the start, its heuristic is 0
+            if limit is not None and expanded >= limit:
+                self.expanded += expanded
+                return False
+            pop(queue)
+            new_key = self._key(cell)
+            if key < new_key:
+                queued[cell] = new_key
+                push(queue, (new_key, cell))
+                continue
+            del queued[cell]
+            expanded += 1
+            if g[cell] > rhs[cell]:
+                g[cell] = cost = rhs[cell]
+                for other, step in adjacent[cell]:
+                    if (other != goal and free[other] and
+                            step + cost < rhs[other]):
+                        rhs[other] = step + cost
+                        enqueue(other)
+            else:
+                old, g[cell] = g[cell], INFINITY
+                for other, step in adjacent[cell]:
+                    if other != goal and rhs[other] == step + old:
+                        rhs[other] = self._lookahead(other)
+                        enqueue(other)
+                enqueue(cell)
+        self.expanded += expanded
+        return True
+
+    def _changed(self, cells):
+        """Cells changed between free and blocked."""
+        for cell in cells:
+            self._free[cell[0] * self.cells + cell[1]] = not self.blocked(cell)
+        if self.goal is None or not cells:
+            return
+        if self.blocked(self.goal):
+            self.goal = None # set_goal starts again from a free cell
+            return
+        g, rhs, goal = self.g, self.rhs, self._goal
+        for cell in cells:
+            cell = cell[0] * self.cells + cell[1]
+            if self._free[cell]:
+                # Its neighbours can't have gone through it, only it changes
+                rhs[cell] = self._lookahead(cell)
+                self._enqueue(cell)
+                continue
+            # Blocked cells are out of the search straight away, the costs of
+            # the neighbours that went through them are looked at again
+            old = g[cell]
+            g[cell] = rhs[cell] = INFINITY
+            self._queued.pop(cell, None)
+            if old == INFINITY:
+                continue
+            for other, step in self._adjacent[cell]:
+                if other != goal and rhs[other] == step + old:
+                    rhs[other] = self._lookahead(other)
+                    self._enqueue(other)
+
+    def free_cell(self, cell, reach=5):
+        """Returns the nearest cell to cell that isn't blocked."""
+        if not self.blocked(cell):
+            return cell
+        near = [(i, j) for i in range(cell[0] - reach, cell[0] + reach + 1)
+                for j in range(cell[1] - reach, cell[1] + reach + 1)
+                if not self.blocked((i, j))]
+        if not near:
+            return cell
+        return min(near, key=lambda c: _octile(c[0] - cell[0], c[1] - cell[1]))
+
+    def plan(self, x, y):
+        """Returns the arena waypoints from the point to the goal, the first
+        being the point itself, or None if there is no way there."""
+        self.forget_robots()
+        cell = self.free_cell(self.cell(x, y))
+        start = cell[0] * self.cells + cell[1]
+        if self.last is None:
+            self.last = start
+        self.km += self._h(self.last, start)
+        self.last = self.start = start
+        if not self._search(MAX_REPAIR):
+            self.restarts += 1
+            goal = self.goal
+            self._restart(goal)
+            self.last = self.start = start
+            self._search()
+        g = self.g
+        if g[start] == INFINITY:
+            return None
+        cells = [start]
+        seen = set(cells)
+        while cells[-1] != self._goal:
+            best = min((step + g[other], other) for other, step in
+                       self._adjacent[cells[-1]] if self._free[other])[1]
+            if g[best] == INFINITY or best in seen:
+                return None
+            cells.append(best)
+            seen.add(best)
+        return [(x, y)] + self._waypoints([self._coords[c] for c in cells])[1:]
+
+    def _waypoints(self, cells):
+        """Cut the cells down to the points where the straight line to the
+        next one would cross a blocked cell."""
+        points = [cells[0]]
+        for i in range(1, len(cells) - 1):
+            if not self._clear(points[-1], cells[i + 1]):
+                points.append(cells[i])
+        points.append(cells[-1])
+        return [self.centre(cell) for cell in points]
+
+    def _clear(self, a, b):
+        steps = int(max(abs(b[0] - a[0]), abs(b[1] - a[1])) * 2) + 1
+        di, dj = float(b[0] - a[0]) / steps, float(b[1] - a[1]) / steps
+        free, n = self._free, self.cells
+        # Both ends are free cells inside the arena, so is all of the line
+        # and adding a half rounds it
+        i, j = a[0] + 0.5, a[1] + 0.5
+        for step in range(steps + 1):
+            if not free[int(i + di * step) * n + int(j + dj * step)]:
+                return False
+        return True
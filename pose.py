@@ -0,0 +1,106 @@
+"""
+    This file is part of Team Brocket Robotics, licensed under the MIT License.
+    A copy of the MIT License can be found in LICENSE.txt
+"""
+
+"""
+Where the robot is, from the arena and slot markers in a frame. Each marker
+seen gives its position relative to the robot and game_map gives its position
+in the arena; the rotation and translation lining the two sets of points up
+is the robot's pose. The weighted least squares fit of that (2D Procrustes)
+has a closed form, so a pose is a single pass of sums over the markers.
+"""
+
+import math
+import collections
+
+import game_map
+from vision_controller import Marker, MARKER_ARENA, MARKER_SLOT
+
+MIN_MARKERS = 2
+MAX_ERROR = 0.15 # meters RMS misfit, worse fits have a misread marker
+NEAR = 0.5 # meters, nearer markers are not weighted any higher
+# Degrees of view the markers have to span, bunched up markers pin the heading
+# down too loosely
+MIN_SPREAD = 10
+
+# heading in degrees anticlockwise from the x axis, error the RMS misfit of
+# the markers in meters
+Pose = collections.namedtuple('Pose', 'x y heading error count timestamp')
+
+def world_position(marker):
+    """Returns the (x, y) of a fixed marker, or None for the ones that move."""
+    if marker.info.marker_type == MARKER_ARENA:
+        position = game_map.ARENA_MARKERS.get(marker.info.code)
+    elif marker.info.marker_type == MARKER_SLOT:
+        position = game_map.SLOTS.get(marker.info.code)
+    else:
+        return None
+    return position[:2] if position is not None else None
+
+def relative_position(marker):
+    """Returns the (x ahead, y to the left) of the marker from the robot."""
+    dist = Marker(marker).horizontal_dist
+    angle = math.radians(marker.rot_y) # to the right
+    return dist * math.cos(angle), -dist * math.sin(angle)
+
+def arena_position(position, marker):
+    """Returns the (x, y) in the arena of a marker seen from the Pose."""
+    ahead, left = relative_position(marker)
+    h = math.radians(position.heading)
+    return (position.x + ahead * math.cos(h) - left * math.sin(h),
+            position.y + ahead * math.sin(h) + left * math.cos(h))
+
+def solve(markers):
+    """Returns the Pose fitting the fixed markers in view, or None if there
+    are too few or they do not agree. The Pose has the timestamp of the
+    MarkerFrame, None for a plain list of markers."""
+    points = []
+    for marker in markers:
+        world = world_position(marker)
+        if world is not None:
+            local = relative_position(marker)
+            # Range and bearing errors grow with the distance
+            weight = 1.0 / max(NEAR, math.hypot(*local)) ** 2
+            points.append((local, world, weight))
+    timestamp = getattr(markers, 'timestamp', None)
+    while len(points) >= MIN_MARKERS and _spread(points) >= MIN_SPREAD:
+        pose, misfits = _fit(points)
+        if pose.error <= MAX_ERROR:
+            return pose._replace(timestamp=timestamp)
+        # Drop the marker that fits worst and try again
+        points.pop(misfits.index(max(misfits)))
+    return None
+
+def _spread(points):
+    bearings = [math.degrees(math.atan2(l[1], l[0])) for l, q, w in points]
+    return max(bearings) - min(bearings)
+
+def _fit(points):
+    total = sum(w for l, q, w in points)
+    lx = sum(w * l[0] for l, q, w in points) / total
+    ly = sum(w * l[1] for l, q, w in points) / total
+    qx = sum(w * q[0] for l, q, w in points) / total
+    qy = sum(w * q[1] for l, q, w in points) / total
+    dot = cross = 0.0
+    for (px, py), (wx, wy), w in points:
+        px, py, wx, wy = px - lx, py - ly, wx - qx, wy - qy
+        dot += w * (px * wx + py * wy)
+        cross += w * (px * wy - py * wx)
+    heading = math.atan2(cross, dot)
+    cos, sin = math.cos(heading), math.sin(heading)
+    x = qx - (cos * lx - sin * ly)
+    y = qy - (sin * lx + cos * ly)
+    misfits = [math.hypot(x + cos * px - sin * py - wx,
+                          y + sin * px + cos * py - wy)
+               for (px, py), (wx, wy), w in points]
+    error = math.sqrt(sum(w * m ** 2 for (l, q, w), m in zip(points, misfits))
+                      / total)
+    return Pose(x, y, math.degrees(heading), error, len(points), None), misfits
+
+def course_to(pose, x, y):
+    """Returns the (meters, degrees to turn left) from the pose to the point."""
+    dx, dy = x - pose.x, y - pose.y
+    bearing = math.degrees(math.atan2(dy, dx))
+    turn = (bearing - pose.heading + 180) % 360 - 180
+    return math.hypot(dx, dy), turn
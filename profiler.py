@@ -0,0 +1,158 @@
+"""
+    This file is part of Team Brocket Robotics, licensed under the MIT License.
+    A copy of the MIT License can be found in LICENSE.txt
+"""
+
+"""
+Where the match time goes. Every visit to a state is timed together with the
+time spent inside the IOInterface primitives during it (drives, turns, servo
+waits, captures and plain waits) and how many of each there were. At the end
+of the match the visits are logged as a timeline and summed up per state.
+"""
+
+import threading
+import contextlib
+
+import clock
+
+PRIMITIVES = ('drive', 'turn', 'servo', 'capture', 'wait')
+
+class Visit(object):
+    def __init__(self, state, start):
+        self.state = state
+        self.start = start
+        self.end = None
+        self.outcome = None # done, error or the interrupt id
+        self.next = None # state changed to
+        self.time = dict((p, 0.0) for p in PRIMITIVES)
+        self.count = dict((p, 0) for p in PRIMITIVES)
+
+    @property
+    def duration(self):
+        end = self.end if self.end is not None else clock.time()
+        return end - self.start
+
+    @property
+    def other(self):
+        """Seconds not spent in any primitive, mostly computing."""
+        return self.duration - sum(self.time.values())
+
+class Profiler(object):
+    def __init__(self):
+        self.visits = []
+        self.current = None
+        self._thread = None # the thread running the states
+        self._depth = 0
+
+    def enter(self, state):
+        if self.current is not None:
+            self.leave('replaced')
+        self.current = Visit(state, clock.time())
+        self.visits.append(self.current)
+        self._thread = threading.current_thread()
+
+    def changed(self, state):
+        if self.current is not None:
+            self.current.next = state
+
+    def leave(self, outcome):
+        if self.current is not None:
+            self.current.end = clock.time()
+            self.current.outcome = outcome
+            self.current = None
+
+    @contextlib.contextmanager
+    def measure(self, primitive):
+        """Time the block against the current visit. Primitives called from
+        inside another, like the waits of a drive, count towards the outer
+        one only."""
+        visit = self.current
+        if (visit is None or self._depth or
+                threading.current_thread() is not self._thread):
+            yield
+            return
+        self._depth += 1
+        start = clock.time()
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            visit.time[primitive] += clock.time() - start
+            visit.count[primitive] += 1
+
+    def _primitives(self, time, count):
+        return ", ".join("%s %.1fs/%d" % (p, time[p], count[p])
+                         for p in PRIMITIVES if count[p])
+
+    def timeline(self, start=None):
+        """Returns a line per visit, times from start or the first visit."""
+        if not self.visits:
+            return []
+        if start is None:
+            start = self.visits[0].start
+        lines = []
+        for visit in self.visits:
+            lines.append("%6.1fs %5.1fs %-14s %-9s -> %-14s %s, other %.1fs" % (
+                visit.start - start, visit.duration, visit.state,
+                visit.outcome or 'running', visit.next or '-',
+                self._primitives(visit.time, visit.count) or 'no io',
+                visit.other))
+        return lines
+
+    def breakdown(self):
+        """Returns {state: totals} over all the visits to each state."""
+        states = {}
+        for visit in self.visits:
+            totals = states.setdefault(visit.state, {
+                'visits': 0, 'seconds': 0.0, 'max': 0.0, 'other': 0.0,
+                'time': dict((p, 0.0) for p in PRIMITIVES),
+                'count': dict((p, 0) for p in PRIMITIVES)})
+            totals['visits'] += 1
+            totals['seconds'] += visit.duration
+            totals['max'] = max(totals['max'], visit.duration)
+            totals['other'] += visit.other
+            for p in PRIMITIVES:
+                totals['time'][p] += visit.time[p]
+                totals['count'][p] += visit.count[p]
+        return states
+
+    def report(self, log, start=None):
+        log.info("Match timeline:")
+        for line in self.timeline(start):
+            log.info(line)
+        states = self.breakdown()
+        match = sum(totals['seconds'] for totals in states.values())
+        log.info("Time per state:")
+        for state, totals in sorted(states.items(),
+                                    key=lambda item: -item[1]['seconds']):
+            log.info("%-14s %5.1fs %3.0f%% n=%d mean %.1fs max %.1fs: %s, "
+                     "other %.1fs", state, totals['seconds'],
+                     100 * totals['seconds'] / match if match else 0,
+                     totals['visits'], totals['seconds'] / totals['visits'],
+                     totals['max'], self._primitives(totals['time'],
+                                                     totals['count']),
+                     totals['other'])
+
+_profiler = None
+
+def active():
+    """Returns the running profiler or None."""
+    return _profiler
+
+def start():
+    global _profiler
+    _profiler = Profiler()
+    return _profiler
+
+def stop():
+    global _profiler
+    _profiler = None
+
+@contextlib.contextmanager
+def measure(primitive):
+    """Profiler.measure of the running profiler, if there is one."""
+    if _profiler is None:
+        yield
+        return
+    with _profiler.measure(primitive):
+        yield
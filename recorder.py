@@ -0,0 +1,180 @@
+"""
+    This file is part of Team Brocket Robotics, licensed under the MIT License.
+    A copy of the MIT License can be found in LICENSE.txt
+"""
+
+"""
+Compact binary recording of a match. Every detection frame, movement
+instruction, servo set and Ruggeduino read is stored as a fixed width record
+in a preallocated ring buffer that a background thread writes out in bulk.
+
+Record layout (little endian, 24 bytes):
+    kind (B), a (B), b (H), timestamp (d), f1 (f), f2 (f), f3 (f)
+
+    FRAME   a=0,            b=marker count, f1,f2=resolution, f3=latency
+    MARKER  a=marker type,  b=code,         f1=dist, f2=rot_y, f3=orientation
+    MOVE    a=move kind,    b=flags,        f1=amount, f2=speed
+    SERVO   a=board,        b=slot,         f1=angle
+    PIN     a=pin,          b=value
+    STATE   a=0,            b=state id,     f1=code of the marker argument or -1
+    START   a=corner
+"""
+
+import zlib
+import struct
+import threading
+import collections
+
+import clock
+
+RECORD = struct.Struct('<BBHdfff')
+FRAME, MARKER, MOVE, SERVO, PIN, STATE, START = range(1, 8)
+MOVE_KINDS = {'Distance': 1, 'Time': 2, 'Left': 3, 'Right': 4, 'Arc': 5,
+              'Path': 6}
+MOVE_REVERSE, MOVE_NO_STOP, MOVE_WHEEL_PIVOT = 1, 2, 4
+
+Record = collections.namedtuple('Record', 'kind a b timestamp f1 f2 f3')
+
+def move_fields(instruction):
+    """Returns the (a, b, f1, f2) fields of a MOVE record."""
+    kind = MOVE_KINDS.get(instruction.__class__.__name__, 0)
+    flags = 0
+    if instruction.reverse:
+        flags |= MOVE_REVERSE
+    if not getattr(instruction, 'stop', True):
+        flags |= MOVE_NO_STOP
+    if getattr(instruction, 'pivot', None) == 'wheel':
+        flags |= MOVE_WHEEL_PIVOT
+    amount = getattr(instruction, 'meters', None)
+    if amount is None:
+        amount = getattr(instruction, 'degree', None)
+    if amount is None:
+        amount = getattr(instruction, 'seconds', 0)
+    return kind, flags, amount, instruction.speed or 0
+
+def state_id(name):
+    return zlib.crc32(name) & 0xffff
+
+def state_fields(name, args):
+    """Returns the (a, b, f1) fields of a STATE record."""
+    code = -1
+    for arg in args:
+        if hasattr(arg, 'info'):
+            code = arg.info.code
+            break
+    return 0, state_id(name), code
+
+class Recorder(object):
+    def __init__(self, path, capacity=8192, flush_interval=1.0):
+        self.path = path
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self._buffer = bytearray(capacity * RECORD.size)
+        self._head = 0 # Total records written into the buffer
+        self._tail = 0 # Total records written out to the file
+        self._last_time = 0.0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self.dropped = 0
+        self.running = True
+        self._file = open(path, 'wb')
+        self._writer = threading.Thread(target=self._write_loop,
+                                        name="recorder")
+        self._writer.daemon = True
+        self._writer.start()
+
+    def _put(self, kind, a=0, b=0, f1=0.0, f2=0.0, f3=0.0, timestamp=None):
+        if timestamp is None:
+            timestamp = clock.time()
+        with self._lock:
+            if self._head - self._tail >= self.capacity:
+                self.dropped += 1
+                return
+            # Keep the timestamps monotonic even if the clock is stepped back
+            timestamp = self._last_time = max(self._last_time, timestamp)
+            offset = (self._head % self.capacity) * RECORD.size
+            RECORD.pack_into(self._buffer, offset, kind, a, b, timestamp,
+                             f1, f2, f3)
+            self._head += 1
+            if self._head - self._tail >= self.capacity / 2:
+                self._wake.set()
+
+    def frame(self, timestamp, res, markers, latency=0.0):
+        res = res or (0, 0)
+        self._put(FRAME, 0, len(markers), res[0], res[1], latency, timestamp)
+        for m in markers:
+            self._put(MARKER, m.info.marker_type, m.info.code, m.dist, m.rot_y,
+                      m.orientation.rot_y, timestamp)
+
+    def move(self, instruction):
+        self._put(MOVE, *move_fields(instruction))
+
+    def servo(self, board, slot, angle):
+        self._put(SERVO, board, slot, angle)
+
+    def pin_read(self, pin, value):
+        self._put(PIN, pin, 1 if value else 0)
+
+    def state(self, name, args):
+        self._put(STATE, *state_fields(name, args))
+
+    def match_start(self, corner):
+        self._put(START, corner)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                head = self._head
+            while self._tail < head:
+                start = self._tail % self.capacity
+                end = min(self.capacity, start + head - self._tail)
+                self._file.write(bytes(self._buffer[start * RECORD.size:
+                                                    end * RECORD.size]))
+                with self._lock:
+                    self._tail += end - start
+            self._file.flush()
+
+    def _write_loop(self):
+        while self.running:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except (IOError, OSError, ValueError):
+                return
+
+    def close(self):
+        self.running = False
+        self._wake.set()
+        self._writer.join(5)
+        self.flush()
+        self._file.close()
+
+def read_records(path):
+    """Yields the records of a recording in order."""
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(RECORD.size * 1024)
+            if not data:
+                break
+            for i in range(0, len(data) - RECORD.size + 1, RECORD.size):
+                yield Record(*RECORD.unpack_from(data, i))
+
+_recorder = None
+
+def active():
+    """Returns the running recorder or None."""
+    return _recorder
+
+def start(path, **kwargs):
+    global _recorder
+    stop()
+    _recorder = Recorder(path, **kwargs)
+    return _recorder
+
+def stop():
+    global _recorder
+    if _recorder is not None:
+        _recorder.close()
+        _recorder = None
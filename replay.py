@@ -0,0 +1,238 @@
+"""
+    This file is part of Team Brocket Robotics, licensed under the MIT License.
+    A copy of the MIT License can be found in LICENSE.txt
+"""
+
+"""
+Replays a match recording (see recorder.py) through the game logic. The
+recorded detection frames and pin reads are fed back in place of the camera
+and the Ruggeduino, on a virtual clock, and the decisions made (state changes,
+chosen markers and movement instructions) are compared with the recording.
+
+    python replay.py match.rec [--corner N] [--verbose]
+"""
+
+import sys
+import difflib
+import logging
+
+import clock
+import recorder
+import simulator
+
+class ReplayFinished(BaseException):
+    """Raised once the recorded frames run out."""
+    pass
+
+class Recording(object):
+    def __init__(self, path):
+        self.path = path
+        self.frames = [] # (timestamp, res, latency, markers)
+        self.pins = {} # pin: [values in the order read]
+        self.servos = {} # (board, slot): angle read at start up
+        self.decisions = [] # MOVE and STATE records
+        self.corner = None
+        self.start = None # clock time of the match start
+        for record in recorder.read_records(path):
+            if record.kind == recorder.FRAME:
+                res = (int(record.f1), int(record.f2))
+                self.frames.append((record.timestamp, res, record.f3, []))
+            elif record.kind == recorder.MARKER:
+                timestamp, res = self.frames[-1][:2]
+                self.frames[-1][3].append(simulator.SimMarker(
+                    record.b, record.a, record.f1, record.f2, record.f3, res,
+                    timestamp))
+            elif record.kind == recorder.SERVO:
+                self.servos.setdefault((record.a, record.b), record.f1)
+            elif record.kind == recorder.PIN:
+                self.pins.setdefault(record.a, []).append(bool(record.b))
+            elif record.kind in (recorder.MOVE, recorder.STATE):
+                self.decisions.append(record)
+            elif record.kind == recorder.START:
+                self.corner = record.a
+                self.start = record.timestamp
+
+class DecisionCollector(object):
+    """Stands in for the recorder during a replay and keeps the decisions."""
+
+    def __init__(self):
+        self.decisions = []
+        self.state_names = {}
+
+    def move(self, instruction):
+        self._add(recorder.MOVE, *recorder.move_fields(instruction))
+
+    def state(self, name, args):
+        self.state_names[recorder.state_id(name)] = name
+        self._add(recorder.STATE, *recorder.state_fields(name, args))
+
+    def _add(self, kind, a=0, b=0, f1=0.0, f2=0.0):
+        self.decisions.append(recorder.Record(kind, a, b, clock.time(),
+                                              f1, f2, 0.0))
+
+    def frame(self, *args):
+        pass
+
+    def servo(self, *args):
+        pass
+
+    def pin_read(self, *args):
+        pass
+
+class _Motor(object):
+    power = 0
+
+class _MotorBoard(object):
+    def __init__(self):
+        self.m0, self.m1 = _Motor(), _Motor()
+
+class _ServoBoard(dict):
+    def __missing__(self, slot):
+        return 0
+
+class _Ruggeduino(object):
+    def __init__(self, pins):
+        self._pins = pins
+        self._modes = {}
+
+    def _is_srduino(self):
+        return True
+
+    def pin_mode(self, pin, mode):
+        self._modes[pin] = mode
+
+    def digital_read(self, pin):
+        values = self._pins.get(pin)
+        value = values.pop(0) if values else False
+        if self._modes.get(pin) == simulator.INPUT_PULLUP:
+            return not value # The recording has the inverted reading
+        return value
+
+    def digital_write(self, pin, value):
+        pass
+
+class ReplayRobot(object):
+    def __init__(self, recording, sim_clock):
+        from motor_controller import MOTOR_MAP
+        from ruggeduino_controller import PIN_MAP
+        self.clock = sim_clock
+        self.frames = list(recording.frames)
+        self.frames_used = 0
+        self.zone = recording.corner
+        self.motors = {MOTOR_MAP['WHEELS'][1]: _MotorBoard()}
+        self.servos = [_ServoBoard() for i in range(max(
+            [board + 1 for board, slot in recording.servos] or [1]))]
+        for (board, slot), angle in recording.servos.items():
+            self.servos[board][slot] = angle
+        pins = dict((pin, list(values))
+                    for pin, values in recording.pins.items())
+        self.ruggeduinos = dict((serial, _Ruggeduino(pins))
+                                for serial, ids in PIN_MAP.values())
+
+    def see(self, res=(800, 600), stats=False):
+        if not self.frames:
+            raise ReplayFinished()
+        timestamp, recorded_res, latency, markers = self.frames.pop(0)
+        self.frames_used += 1
+        # Line the clock up with the recording, never step it back
+        self.clock.advance(timestamp - self.clock.time())
+        self.clock.advance(latency)
+        if stats:
+            return markers, {'cam': 0.0, 'yuyv': 0.0, 'find_markers': latency}
+        return markers
+
+class ReplayResult(object):
+    def __init__(self, recording, collector, frames_used):
+        self.recording = recording
+        self.decisions = collector.decisions
+        self.state_names = collector.state_names
+        self.frames_used = frames_used
+        self.divergences = compare(recording.decisions, self.decisions)
+
+    def describe(self, record):
+        if record.kind == recorder.STATE:
+            name = self.state_names.get(record.b, "state#%d" % record.b)
+            if record.f1 >= 0:
+                return "%s(marker %d)" % (name, record.f1)
+            return name
+        kinds = dict((v, k) for k, v in recorder.MOVE_KINDS.items())
+        return "%s(%.2f, speed %.0f, flags %d)" % (
+            kinds.get(record.a, 'Move'), record.f1, record.f2, record.b)
+
+    def report(self):
+        lines = ["Replayed %d of %d frames, %d recorded and %d replayed "
+                 "decisions" % (self.frames_used, len(self.recording.frames),
+                                len(self.recording.decisions),
+                                len(self.decisions))]
+        if not self.divergences:
+            lines.append("No divergence from the recording")
+        for tag, recorded, replayed in self.divergences:
+            at = (recorded or replayed)[0].timestamp
+            lines.append("%s at %.1fs: recorded [%s] replayed [%s]" % (
+                tag, at, self._describe_all(recorded),
+                self._describe_all(replayed)))
+        return "\n".join(lines)
+
+    def _describe_all(self, records, limit=4):
+        text = ", ".join(map(self.describe, records[:limit]))
+        if len(records) > limit:
+            text += ", +%d more" % (len(records) - limit)
+        return text
+
+def _key(record):
+    if record.kind == recorder.STATE:
+        return record.kind, record.b, int(record.f1)
+    return (record.kind, record.a, record.b, round(record.f1, 2),
+            round(record.f2, 1))
+
+def compare(recorded, replayed):
+    """Returns the (tag, recorded records, replayed records) where the
+    decisions differ. Decisions after the end of the recording are ignored."""
+    matcher = difflib.SequenceMatcher(None, map(_key, recorded),
+                                      map(_key, replayed), autojunk=False)
+    divergences = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal' or (tag == 'insert' and i1 == len(recorded)):
+            continue
+        divergences.append((tag, recorded[i1:i2], replayed[j1:j2]))
+    return divergences
+
+def replay(path, corner=None, verbose=False):
+    """Run the game logic against a recording, returns a ReplayResult."""
+    simulator.install()
+    import IOInterface
+    import gamelogic
+    recording = Recording(path)
+    if corner is None:
+        corner = recording.corner or 0
+    sim_clock = clock.VirtualClock()
+    old_clock = clock.set_clock(sim_clock)
+    old_recorder = recorder._recorder
+    collector = recorder._recorder = DecisionCollector()
+    R = ReplayRobot(recording, sim_clock)
+    log = logging.getLogger('Robot')
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setLevel(logging.INFO if verbose else logging.CRITICAL)
+    log.addHandler(handler)
+    log.setLevel(logging.DEBUG if verbose else logging.CRITICAL)
+    try:
+        io = IOInterface.IOInterface(R)
+        gamelogic.PlayGame(log, io, corner, recording.start)
+    except ReplayFinished:
+        pass
+    finally:
+        log.removeHandler(handler)
+        recorder._recorder = old_recorder
+        clock.set_clock(old_clock)
+    return ReplayResult(recording, collector, R.frames_used)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Replay a match recording")
+    parser.add_argument('recording')
+    parser.add_argument('--corner', type=int, default=None)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    result = replay(args.recording, args.corner, args.verbose)
+    print result.report()
+    sys.exit(1 if result.divergences else 0)
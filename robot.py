@@ -12,9 +12,16 @@ from subprocess import Popen
 from sr.robot import Robot
 
 from IOInterface import IOInterface
+from log_sink import AsyncHandler
+import recorder
+import calibration
+import clock
+import profiler
 
 RUN_TESTS = False
 COMP_MODE = True
+RECORD_MATCH = True # Binary recording of frames, moves and sensor reads
+PROFILE_MATCH = True # Log where the match time went at the end
 
 def setup_logger(root):
     logger = logging.getLogger('Robot')
@@ -33,10 +40,12 @@ def setup_logger(root):
     while os.path.exists(filename):
         filename = os.path.join(path, time.strftime("%H.%M.%S", time.localtime()) + "_%d.log" % i)
         i += 1
-    file_log = logging.FileHandler(filename)
+    # Writes to the USB key are slow, keep them off the control thread
+    file_log = AsyncHandler(logging.FileHandler(filename))
     file_log.setLevel(logging.DEBUG)
     file_log.setFormatter(logging.Formatter('%(asctime)s@%(threadName)s [%(levelname)s] [%(name)s,%(funcName)s:%(lineno)d] %(message)s'))
     logger.addHandler(file_log)
+    logger.log_file = filename
 
     return logger
 
@@ -59,20 +68,33 @@ def setup():
     set_time(R.usbkey)
     logger = setup_logger(R.usbkey)
     logger.info('Battery Voltage: %.2f' % R.power.battery.voltage)
+    if RECORD_MATCH:
+        recorder.start(os.path.splitext(logger.log_file)[0] + ".rec")
+    tables = calibration.load(R.usbkey)
+    logger.info('Motor calibration: %s', ', '.join(sorted(tables)) or 'none')
     R.wait_start()
+    match_start = clock.time()
+    if RECORD_MATCH:
+        recorder.active().match_start(R.zone)
+    if PROFILE_MATCH:
+        profiler.start()
     try:
         io = IOInterface(R)
     except:
         logger.exception("IOInterface could not initialize")
         raise
-    return logger, io, R.zone
+    io.start_sensors()
+    return logger, io, R.zone, match_start
 
 if __name__ == '__main__' or __name__ == '__builtin__':
-    logger, io, corner = setup()
-    if RUN_TESTS:
-        import tests
-        global R
-        tests.run(logger, io, R)
-    else:
-        import gamelogic
-        gamelogic.PlayGame(logger, io, corner)
+    logger, io, corner, match_start = setup()
+    try:
+        if RUN_TESTS:
+            import tests
+            global R
+            tests.run(logger, io, R)
+        else:
+            import gamelogic
+            gamelogic.PlayGame(logger, io, corner, match_start)
+    finally:
+        recorder.stop() # flush the last of the recording to the USB key
@@ -3,6 +3,7 @@
     A copy of the MIT License can be found in LICENSE.txt
 """
 
+import recorder
 from sr.ruggeduino import (INPUT,
                            OUTPUT,
                            INPUT_PULLUP)
@@ -14,6 +15,11 @@ PIN_TYPES = {  # mode, signal_type {digital or analogue}
     'SENSOR_SRC': (OUTPUT, 'digital')
 }
 
+# Firmware extension (see firmware/srduino.ino): one command reads every
+# digital pin, the reply is a hex bitmask of the pin levels
+BULK_READ = 'R'
+BULK_VERSION_TAG = 'bulk'
+
 PIN_MAP = {  # type: (board_serial, identifier: pin_no)
 #    'BUMP': ('75230313833351314151', {
 #            'BACK_L': 9,
@@ -70,6 +76,9 @@ class RuggeduinoController:
         method = getattr(ruggeduino, function)
         invert = info[0] == INPUT_PULLUP and info[1] == 'digital'
         self._ruggeduino = (method, pin, invert)
+        self.pin = pin
+        self.is_digital = info[1] == 'digital'
+        self.bank = PinBank.for_board(ruggeduino)
         def toString():
             return  "Ruggeduino(%s.%s)" % (type, id)
         self.__str__ = toString
@@ -83,13 +92,73 @@ class RuggeduinoController:
     def read(self):
         """Returns the value of the pin, float for analogue - the voltage,
         and boolean for digital - True for high and False for low."""
+        value = self.read_raw()
+        rec = recorder.active()
+        if rec is not None:
+            rec.pin_read(self._ruggeduino[1], value)
+        return value
+
+    def read_raw(self):
+        """Read the pin without recording the value."""
         if not self.is_input:
             raise TypeError("Trying to read a non-input pin")
         return self._run()
 
+    def from_mask(self, mask):
+        """Returns the value of the pin from a bulk read bitmask."""
+        value = bool(mask & (1 << self.pin))
+        if self._ruggeduino[2]: value = not value
+        return value
+
     def write(self, value):
         """Write a value to the pin,
         boolean only - True for high and False for low."""
         if not self.is_output:
             raise TypeError("Trying to write to a non-output pin")
         return self._run(value)
+
+class PinBank(object):
+    """Bulk reads of the digital pins of one board, if its firmware has the
+    extension."""
+    _banks = {}
+
+    @classmethod
+    def for_board(cls, ruggeduino):
+        bank = cls._banks.get(id(ruggeduino))
+        if bank is None or bank.board is not ruggeduino:
+            bank = cls._banks[id(ruggeduino)] = cls(ruggeduino)
+        return bank
+
+    def __init__(self, ruggeduino):
+        self.board = ruggeduino
+        self._supported = None
+
+    @property
+    def supported(self):
+        if self._supported is None:
+            self._supported = False
+            if hasattr(self.board, 'command'):
+                version = self.board.command('v')
+                self._supported = BULK_VERSION_TAG in version.split(':', 1)[-1]
+        return self._supported
+
+    def read_mask(self):
+        """Returns the levels of all the digital pins as a bitmask."""
+        return int(self.board.command(BULK_READ).strip(), 16)
+
+def read_many(controllers):
+    """Read several inputs, with one bulk read per board where the firmware
+    allows it. Returns the values in the same order, nothing is recorded."""
+    values = {}
+    by_bank = {}
+    for controller in controllers:
+        if not controller.is_input:
+            raise TypeError("Trying to read a non-input pin")
+        if controller.is_digital:
+            by_bank.setdefault(controller.bank, []).append(controller)
+    for bank, group in by_bank.items():
+        if len(group) > 1 and bank.supported:
+            mask = bank.read_mask()
+            for controller in group:
+                values[controller] = controller.from_mask(mask)
+    return [values[c] if c in values else c.read_raw() for c in controllers]
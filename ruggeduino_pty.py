@@ -0,0 +1,169 @@
+"""
+    This file is part of Team Brocket Robotics, licensed under the MIT License.
+    A copy of the MIT License can be found in LICENSE.txt
+"""
+
+"""
+Stand-in for a Ruggeduino on a pseudo-terminal, running the protocol of
+firmware/srduino.ino with a configurable reply latency, so serial reads can be
+timed without the board.
+
+    python ruggeduino_pty.py [--latency MS] [--reads N] [--no-bulk]
+"""
+
+import os
+import pty
+import tty
+import time
+import select
+import threading
+
+# Pin levels of an idle board, the pull ups hold the switch inputs high
+IDLE_PINS = 0x3ffc
+
+class FakeBoard(object):
+    def __init__(self, latency=0.002, bulk=True, pins=IDLE_PINS):
+        self.latency = latency # seconds before each reply
+        self.bulk = bulk
+        self.pins = pins
+        self.modes = {}
+        self.commands = 0
+        self.running = True
+        self._master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.path = os.ttyname(slave)
+        self._slave = slave # kept open so the pty stays alive
+        self._thread = threading.Thread(target=self._serve,
+                                        name="fake_ruggeduino")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def set_pin(self, pin, level):
+        if level:
+            self.pins |= 1 << pin
+        else:
+            self.pins &= ~(1 << pin)
+
+    def _read(self):
+        while self.running:
+            ready, _, _ = select.select([self._master], [], [], 0.1)
+            if ready:
+                return os.read(self._master, 1)
+        return ''
+
+    def _serve(self):
+        while self.running:
+            command = self._read()
+            if not command:
+                continue
+            reply = self._handle(command)
+            if reply is None:
+                continue
+            self.commands += 1
+            if self.latency:
+                time.sleep(self.latency)
+            os.write(self._master, reply + "\n")
+
+    def _handle(self, command):
+        if command == 'v':
+            return "SRduino:" + ("1-bulk" if self.bulk else "1")
+        if command == 'R' and self.bulk:
+            return "%X" % self.pins
+        if command not in 'ioprlha':
+            return None
+        pin = ord(self._read()) - ord('a')
+        if command in 'iop':
+            self.modes[pin] = command
+        elif command == 'r':
+            return 'h' if self.pins & (1 << pin) else 'l'
+        elif command in 'lh':
+            self.set_pin(pin, command == 'h')
+        elif command == 'a':
+            return "0"
+        return ""
+
+    def close(self):
+        self.running = False
+        self._thread.join(1)
+        os.close(self._master)
+        os.close(self._slave)
+
+class SerialRuggeduino(object):
+    """Minimal client with the methods RuggeduinoController uses from
+    sr.ruggeduino.Ruggeduino, talking to a tty."""
+
+    def __init__(self, path):
+        self._fd = os.open(path, os.O_RDWR | os.O_NOCTTY)
+        tty.setraw(self._fd)
+        self.lock = threading.Lock()
+
+    def command(self, data):
+        with self.lock:
+            os.write(self._fd, "".join(data))
+            line = ""
+            while not line.endswith("\n"):
+                line += os.read(self._fd, 64)
+            return line
+
+    def _is_srduino(self):
+        return self.command('v').split(':')[0] == 'SRduino'
+
+    def pin_mode(self, pin, mode):
+        self.command(({'INPUT': 'i', 'OUTPUT': 'o', 'INPUT_PULLUP': 'p'}
+                      .get(mode, mode), chr(ord('a') + pin)))
+
+    def digital_read(self, pin):
+        return self.command(('r', chr(ord('a') + pin)))[0] == 'h'
+
+    def digital_write(self, pin, value):
+        self.command(('h' if value else 'l', chr(ord('a') + pin)))
+
+    def close(self):
+        os.close(self._fd)
+
+def benchmark(latency=0.002, reads=200, bulk=True):
+    """Time reading the token sensors through RuggeduinoController one pin at
+    a time and with a bulk read. Returns {method: seconds per read}."""
+    try:
+        import sr.ruggeduino
+    except ImportError:
+        import simulator
+        simulator.install() # only the pin mode constants are needed
+    from ruggeduino_controller import RuggeduinoController, PIN_MAP, read_many
+    board = FakeBoard(latency, bulk)
+    client = SerialRuggeduino(board.path)
+
+    class Robot(object):
+        ruggeduinos = {PIN_MAP['SENSOR'][0]: client}
+
+    sensors = [RuggeduinoController(Robot, type='sensor', id=id)
+               for id in sorted(PIN_MAP['SENSOR'][1])]
+    results = {}
+    try:
+        start = time.time()
+        for i in range(reads):
+            [sensor.read_raw() for sensor in sensors]
+        results['per pin'] = (time.time() - start) / reads
+        start = time.time()
+        for i in range(reads):
+            read_many(sensors)
+        results['bulk'] = (time.time() - start) / reads
+    finally:
+        client.close()
+        board.close()
+    return results
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Time Ruggeduino pin reads "
+                                     "against a pseudo-terminal stand-in")
+    parser.add_argument('--latency', type=float, default=2.0,
+                        help="Board reply latency in milliseconds")
+    parser.add_argument('--reads', type=int, default=200)
+    parser.add_argument('--no-bulk', action='store_true',
+                        help="Firmware without the bulk read extension")
+    args = parser.parse_args()
+    results = benchmark(args.latency / 1000.0, args.reads, not args.no_bulk)
+    for method, seconds in sorted(results.items()):
+        print "%-7s %.2f ms per read of both token sensors" % (method,
+                                                             seconds * 1000)
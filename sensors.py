@@ -0,0 +1,146 @@
+"""
+    This file is part of Team Brocket Robotics, licensed under the MIT License.
+    A copy of the MIT License can be found in LICENSE.txt
+"""
+
+"""
+One service reading every registered Ruggeduino input. A single thread polls
+all of them at a fixed rate, keeps the latest values with their timestamps,
+debounces them and calls the rising/falling edge callbacks. The control thread
+reads the cached values instead of asking the board each time.
+"""
+
+import threading
+
+import clock
+import recorder
+from ruggeduino_controller import read_many
+
+DEFAULT_RATE = 50 # polls per second
+
+class _Input(object):
+    def __init__(self, controller, debounce, on_rise, on_fall):
+        self.controller = controller
+        self.debounce = debounce
+        self.on_rise = on_rise
+        self.on_fall = on_fall
+        self.value = None # debounced value
+        self.raw = None
+        self.raw_since = None # when the raw value last changed
+        self.timestamp = None # when the pin was last read
+
+class SensorService(object):
+    def __init__(self, rate=DEFAULT_RATE):
+        self.interval = 1.0 / rate
+        self.max_age = 2.5 * self.interval # oldest value read() will return
+        self.polling = False
+        self.polls = 0
+        self._inputs = {}
+        self._lock = threading.Lock()
+
+    def register(self, controller, debounce=0.0, on_rise=None, on_fall=None):
+        """Poll the input controller. A change has to last debounce seconds
+        before it counts, on_rise and on_fall are called with the controller
+        (on the polling thread) when the debounced value goes high or low."""
+        if not controller.is_input:
+            raise TypeError("%s is not an input" % controller)
+        with self._lock:
+            self._inputs[controller] = _Input(controller, debounce, on_rise,
+                                              on_fall)
+
+    def poll(self):
+        """Read all the inputs once and fire the edge callbacks."""
+        edges = []
+        sensors = self._inputs.values()
+        values = read_many([sensor.controller for sensor in sensors])
+        now = clock.time()
+        for sensor, value in zip(sensors, values):
+            with self._lock:
+                edge = self._update(sensor, value, now)
+            if edge is not None:
+                edges.append((edge, sensor.controller))
+        self.polls += 1
+        for callback, controller in edges:
+            callback(controller)
+
+    def _update(self, sensor, value, now):
+        """Returns the edge callback to fire, if the value changed."""
+        sensor.timestamp = now
+        if value != sensor.raw:
+            sensor.raw = value
+            sensor.raw_since = now
+        if sensor.value is None:
+            sensor.value = value # first reading, no edge
+            return None
+        if (sensor.raw != sensor.value and
+                now - sensor.raw_since >= sensor.debounce):
+            sensor.value = sensor.raw
+            return sensor.on_rise if sensor.value else sensor.on_fall
+        return None
+
+    def read(self, controller, max_age=None):
+        """Returns the debounced value of the input if it was polled within
+        max_age seconds, otherwise reads the pin there and then."""
+        return self.read_many([controller], max_age)[0]
+
+    def read_many(self, controllers, max_age=None):
+        """read() for several inputs, the stale ones are read together. A
+        stale input that changed is read again once its debounce time is up,
+        so the values returned are always the debounced ones."""
+        if max_age is None:
+            max_age = self.max_age
+        now = clock.time()
+        values = {}
+        stale = []
+        with self._lock:
+            for controller in controllers:
+                sensor = self._inputs.get(controller)
+                if (sensor is not None and sensor.timestamp is not None and
+                        now - sensor.timestamp <= max_age):
+                    values[controller] = sensor.value
+                else:
+                    stale.append(controller)
+        rec = recorder.active()
+        if rec is not None:
+            for controller in controllers:
+                if controller in values:
+                    rec.pin_read(controller.pin, values[controller])
+        edges = []
+        settling = self._read(stale, values, edges, clock.time())
+        if settling:
+            settled = max(sensor.raw_since + sensor.debounce
+                          for sensor in settling)
+            clock.sleep(settled - clock.time())
+            self._read([sensor.controller for sensor in settling], values,
+                       edges, max(settled, clock.time()))
+        for callback, controller in edges:
+            callback(controller)
+        return [values[controller] for controller in controllers]
+
+    def _read(self, controllers, values, edges, now):
+        """Read the pins of the controllers now, put their values in values
+        and the edges to fire in edges. Returns the sensors whose raw value
+        has not lasted long enough to count yet."""
+        settling = []
+        rec = recorder.active()
+        for controller, value in zip(controllers, read_many(controllers)):
+            if rec is not None:
+                rec.pin_read(controller.pin, value)
+            sensor = self._inputs.get(controller)
+            if sensor is None:
+                values[controller] = value
+                continue
+            with self._lock:
+                edge = self._update(sensor, value, now)
+                values[controller] = sensor.value
+            if edge is not None:
+                edges.append((edge, controller))
+            if sensor.raw != sensor.value:
+                settling.append(sensor)
+        return settling
+
+    def last_read(self, controller):
+        """Returns the (value, timestamp) of the last poll of the input."""
+        sensor = self._inputs[controller]
+        with self._lock:
+            return sensor.value, sensor.timestamp
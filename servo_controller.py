@@ -3,10 +3,48 @@
     A copy of the MIT License can be found in LICENSE.txt
 """
 
+import clock
+import recorder
+
 SERVO_MAP = { # type: (Min rotation, Max rotation, servo board, servo slot)
     'GRABBER': (1, 50, 0, 6),
     'ARM': (1, 81, 0, 0)
 }
+SERVO_SPEED = { # type: angle units per second, full travel in 0.5s / 0.7s
+    'GRABBER': 70.0,
+    'ARM': 160.0
+}
+SETTLE_TIME = 0.05 # seconds added to every move for the servo to settle
+
+class ServoMove(object):
+    """Completion handle of a servo move, predicted from the servo speed."""
+
+    def __init__(self, start, target, start_time, duration):
+        self.start = start
+        self.target = target
+        self.start_time = start_time
+        self.end_time = start_time + duration
+
+    def remaining(self):
+        return max(0.0, self.end_time - clock.time())
+
+    def done(self):
+        return self.remaining() == 0
+
+    def position(self):
+        """Estimated angle of the servo now."""
+        duration = self.end_time - self.start_time
+        if duration <= 0 or self.done():
+            return self.target
+        progress = min(1.0, (clock.time() - self.start_time) / duration)
+        return self.start + (self.target - self.start) * progress
+
+    def wait(self, sleep=clock.sleep):
+        sleep(self.remaining())
+
+    def __repr__(self):
+        return "<ServoMove %s->%s %.2fs left>" % (self.start, self.target,
+                                                  self.remaining())
 
 class ServoController(object):
     def __init__(self, robot, type):
@@ -21,19 +59,45 @@ class ServoController(object):
         if slot < 0 or slot > 7:
             raise IndexError("There are only 8 servo outputs on a servo board")
         self._servo = (robot.servos[board], slot)
+        self._board = board
         self.MIN, self.MAX = data[:2]
+        self.speed = SERVO_SPEED[type.upper()]
+        # Shadow of the commanded angle, the board is only read here
+        angle = self._servo[0][self._servo[1]]
+        self._angle = max(self.MIN, min(self.MAX, angle))
+        self._move = ServoMove(self._angle, self._angle, clock.time(), 0)
+        rec = recorder.active()
+        if rec is not None:
+            rec.servo(board, slot, self._angle) # where replays start from
 
     def set_angle(self, angle):
+        """Start moving to the angle, returns the ServoMove handle."""
         if angle < self.MIN or angle > self.MAX:
             raise ValueError("Cannot set angle greater or less than max or min")
+        start = self.position()
         self._servo[0][self._servo[1]] = angle
+        duration = self.move_time(start, angle)
+        self._angle = angle
+        self._move = ServoMove(start, angle, clock.time(), duration)
+        rec = recorder.active()
+        if rec is not None:
+            rec.servo(self._board, self._servo[1], angle)
+        return self._move
+
+    def move_time(self, start, angle):
+        """Predicted seconds to move from start to angle."""
+        if start == angle:
+            return 0.0
+        return abs(angle - start) / self.speed + SETTLE_TIME
 
     def get_angle(self):
-        angle = self._servo[0][self._servo[1]]
-        if angle < self.MIN:
-            self.set_angle(self.MIN)
-            angle = self.MIN
-        elif angle > self.MAX:
-            self.set_angle(self.MAX)
-            angle = self.MAX
-        return angle
+        """Returns the last angle set."""
+        return self._angle
+
+    def position(self):
+        """Estimated angle of the servo now, part way through a move."""
+        return self._move.position()
+
+    def moving(self):
+        """Returns the ServoMove in progress or None."""
+        return None if self._move.done() else self._move
@@ -0,0 +1,559 @@
+"""
+    This file is part of Team Brocket Robotics, licensed under the MIT License.
+    A copy of the MIT License can be found in LICENSE.txt
+"""
+
+"""
+Simulated arena backend standing in for the sr.robot, sr.vision and
+sr.ruggeduino libraries so the game logic can be run on a laptop.
+
+    python simulator.py [--corner N] [--seed N] [--scale N] [--quiet]
+
+install() registers fake sr modules in sys.modules, it must be called before
+any of the robot modules are imported.
+"""
+
+import sys
+import math
+import random
+import tempfile
+import types
+import logging
+import threading
+
+from game_map import (ARENA_SIZE, ARENA_MARKERS, PLATFORM, SLOTS, START_POSE,
+                      corner_transform)
+
+MARKER_ARENA, MARKER_ROBOT, MARKER_TOKEN_TOP, MARKER_TOKEN_BOTTOM, \
+    MARKER_TOKEN_SIDE, MARKER_SLOT = range(6)
+INPUT, OUTPUT, INPUT_PULLUP = ('INPUT', 'OUTPUT', 'INPUT_PULLUP')
+
+MATCH_LENGTH = 180
+ROBOT_RADIUS = 0.2
+
+MARKER_SIZE = {
+    MARKER_ARENA: 0.25,
+    MARKER_ROBOT: 0.1,
+    MARKER_SLOT: 0.1,
+    MARKER_TOKEN_TOP: 0.1,
+    MARKER_TOKEN_BOTTOM: 0.1,
+    MARKER_TOKEN_SIDE: 0.1
+}
+MARKER_HEIGHT = {  # Height of the marker centre above the floor
+    MARKER_ARENA: 0.05 + 0.125,
+    MARKER_ROBOT: 0.25 + 0.05,
+    MARKER_SLOT: 0.02 + 0.05,
+    MARKER_TOKEN_SIDE: 0.05
+}
+
+CAMERA_HEIGHT = 0.376
+CAMERA_FOV = 30  # Half the horizontal field of view in degrees
+MAX_VIEW_ANGLE = 70  # A marker turned further than this can't be read
+# Range a marker of 1m would be read at with a 960 pixel wide image
+RANGE_PER_METER = 28.0
+TOKEN_MIN_DIST = 0.45  # Tokens on the floor drop below the camera view
+
+# Physical robot, left wheel runs faster (see rpmoffset in motor_controller)
+WHEEL_MAX_RPM = {'LEFT': 112, 'RIGHT': 106}
+WHEEL_DIAMETER = 0.1013
+WHEEL_SPAN = 0.378
+MOTOR_DEADBAND = 6
+TURN_SLIP = 0.93  # Wheel scrub loses some rotation
+SERVO_SPEED = 150.0  # Servo units per second
+
+# Token positions in the frame of corner 0, the first one starts in the grabber
+TOKEN_LAYOUT = [(0.74, 0.74), (1.4, 2.8), (2.8, 1.4)]
+
+
+class MatchOver(BaseException):
+    """Raised out of the simulated hardware once the match time is up."""
+    pass
+
+
+def normalize(angle):
+    """Wrap an angle in degrees into -180 to 180."""
+    return (angle + 180) % 360 - 180
+
+
+class _Struct(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, ", ".join(
+            "%s=%r" % kv for kv in sorted(self.__dict__.items())))
+
+
+class MarkerInfo(_Struct): pass
+class Point(_Struct): pass
+class Orientation(_Struct): pass
+
+
+class SimMarker(_Struct):
+    def __init__(self, code, marker_type, dist, rot_y, orient, res, timestamp):
+        size = MARKER_SIZE[marker_type]
+        super(SimMarker, self).__init__(
+            info=MarkerInfo(code=code, marker_type=marker_type, size=size,
+                            offset=code),
+            dist=dist, rot_y=rot_y, orientation=Orientation(rot_x=0, rot_y=orient,
+                                                            rot_z=0),
+            centre=Point(polar=Point(length=dist, rot_x=0, rot_y=rot_y)),
+            res=res, timestamp=timestamp)
+
+
+class SimToken(object):
+    def __init__(self, code, x, y, yaw):
+        self.code = code
+        self.x, self.y, self.yaw = x, y, yaw
+        self.held = False
+        self.scored = None
+
+
+class World(object):
+    """Kinematic model of the arena and our robot, updated lazily up to the
+    current clock time whenever the robot code touches the hardware."""
+
+    def __init__(self, clock, corner=0, seed=0, opponents=True):
+        self.clock = clock
+        self.corner = corner
+        self.rand = random.Random(seed)
+        x, y, h = corner_transform(corner, *START_POSE)
+        self.x, self.y, self.heading = x, y, h
+        self.power = {'LEFT': 0, 'RIGHT': 0}
+        self.servos = {}
+        self.servo_targets = {}
+        self.arm_slot = self.grabber_slot = None
+        self.start = self.last_update = clock.time()
+        self._lock = threading.RLock() # the sensor thread updates it too
+        self.distance = 0.0
+        self.captures = 0
+        self.markers = self._arena_markers()
+        self.tokens = []
+        for c in range(4):
+            for i, pos in enumerate(TOKEN_LAYOUT):
+                tx, ty, yaw = corner_transform(c, pos[0], pos[1],
+                                               self.rand.uniform(0, 90))
+                self.tokens.append(SimToken(40 + c + 4 * i, tx, ty, yaw))
+        self.robots = []
+        if opponents:
+            for c in range(4):
+                if c != corner:
+                    rx, ry, rh = corner_transform(c, *START_POSE)
+                    self.robots.append((28 + c, rx, ry))
+        self.held = None
+
+    def _arena_markers(self):
+        markers = []
+        for code, (x, y, facing) in sorted(ARENA_MARKERS.items()):
+            markers.append((code, MARKER_ARENA, x, y, facing))
+        for code, (x, y, facing) in SLOTS.items():
+            markers.append((code, MARKER_SLOT, x, y, facing))
+        return markers
+
+    def set_power(self, wheel, power):
+        self.update()
+        self.power[wheel] = max(-100, min(100, power))
+
+    def register_servos(self, arm_slot, grabber_slot, arm, grabber):
+        self.arm_slot, self.grabber_slot = arm_slot, grabber_slot
+        self.arm, self.grabber = arm, grabber
+        self.servos[arm_slot] = self.servo_targets[arm_slot] = arm[1]
+        self.servos[grabber_slot] = self.servo_targets[grabber_slot] = grabber[0]
+
+    def set_servo(self, slot, value):
+        self.update()
+        self.servo_targets[slot] = value
+        self.servos.setdefault(slot, value)
+
+    def get_servo(self, slot):
+        self.update()
+        return self.servo_targets.get(slot, 0)
+
+    def wheel_speed(self, wheel):
+        power = self.power[wheel]
+        if abs(power) < MOTOR_DEADBAND:
+            return 0.0
+        fraction = ((abs(power) - MOTOR_DEADBAND) /
+                    (100.0 - MOTOR_DEADBAND)) ** 1.1
+        rpm = WHEEL_MAX_RPM[wheel] * fraction
+        speed = rpm / 60.0 * math.pi * WHEEL_DIAMETER
+        return speed if power > 0 else -speed
+
+    def update(self, end_match=True):
+        """Step the world up to now. Raises MatchOver once the match is over,
+        unless end_match is False."""
+        with self._lock:
+            now = self.clock.time()
+            if end_match and now - self.start > MATCH_LENGTH:
+                raise MatchOver()
+            while self.last_update < now:
+                dt = min(0.05, now - self.last_update)
+                self._step(dt)
+                self.last_update += dt
+
+    def _step(self, dt):
+        for slot, target in self.servo_targets.items():
+            current = self.servos[slot]
+            step = SERVO_SPEED * dt
+            if abs(target - current) <= step:
+                self.servos[slot] = target
+            else:
+                self.servos[slot] = current + math.copysign(step, target - current)
+        self._check_grabber()
+        vl, vr = self.wheel_speed('LEFT'), self.wheel_speed('RIGHT')
+        if vl == 0 and vr == 0:
+            return
+        v = (vl + vr) / 2.0
+        w = (vr - vl) / WHEEL_SPAN * TURN_SLIP
+        h = math.radians(self.heading)
+        if abs(w) < 1e-9:
+            nx, ny = self.x + v * dt * math.cos(h), self.y + v * dt * math.sin(h)
+        else:
+            r = v / w
+            nx = self.x + r * (math.sin(h + w * dt) - math.sin(h))
+            ny = self.y - r * (math.cos(h + w * dt) - math.cos(h))
+        self.heading = normalize(self.heading + math.degrees(w * dt))
+        lo, hi = ROBOT_RADIUS, ARENA_SIZE - ROBOT_RADIUS
+        nx, ny = max(lo, min(hi, nx)), max(lo, min(hi, ny))
+        px1, py1, px2, py2 = PLATFORM
+        if (px1 - ROBOT_RADIUS < nx < px2 + ROBOT_RADIUS and
+                py1 - ROBOT_RADIUS < ny < py2 + ROBOT_RADIUS):
+            nx, ny = self.x, self.y  # Blocked by the platform
+        self.distance += math.hypot(nx - self.x, ny - self.y)
+        self.x, self.y = nx, ny
+        self._push_tokens()
+
+    def _mouth_offset(self, token):
+        """Returns (forward, lateral) of a token relative to the robot."""
+        h = math.radians(self.heading)
+        dx, dy = token.x - self.x, token.y - self.y
+        return (dx * math.cos(h) + dy * math.sin(h),
+                -dx * math.sin(h) + dy * math.cos(h))
+
+    def _push_tokens(self):
+        h = math.radians(self.heading)
+        for token in self.tokens:
+            if token.held:
+                token.x = self.x + 0.2 * math.cos(h)
+                token.y = self.y + 0.2 * math.sin(h)
+                continue
+            if token.scored is not None:
+                continue
+            fwd, lat = self._mouth_offset(token)
+            if 0 < fwd < 0.15 and abs(lat) < 0.12:
+                # Token is pushed along in the mouth of the grabber
+                token.x += (0.15 - fwd) * math.cos(h)
+                token.y += (0.15 - fwd) * math.sin(h)
+
+    def _token_in_mouth(self):
+        if self.held is not None:
+            return self.held
+        for token in self.tokens:
+            if token.scored is not None:
+                continue
+            fwd, lat = self._mouth_offset(token)
+            if 0.1 <= fwd <= 0.3 and abs(lat) < 0.12:
+                return token
+        return None
+
+    def _check_grabber(self):
+        if self.grabber_slot is None:
+            return
+        grabber = self.servos[self.grabber_slot]
+        arm = self.servos[self.arm_slot]
+        closed = grabber >= self.grabber[1] * 0.8
+        opened = grabber <= self.grabber[1] * 0.2
+        if self.held is None and closed and arm >= self.arm[1] * 0.85:
+            token = self._token_in_mouth()
+            if token is not None:
+                token.held = True
+                self.held = token
+        elif self.held is not None and opened:
+            token, self.held = self.held, None
+            token.held = False
+            if arm <= self.arm[1] * 0.6:
+                for code, (x, y, facing) in SLOTS.items():
+                    if math.hypot(token.x - x, token.y - y) < 0.4:
+                        token.scored = code
+                        logging.getLogger('Robot.Sim').info(
+                            "Token %d placed in slot %d", token.code, code)
+                        break
+
+    def read_token_sensor(self):
+        self.update(False) # the match ends on the control thread
+        return self._token_in_mouth() is not None
+
+    def _observe(self, x, y, height, facing=None):
+        """Returns (dist, rot_y, orientation) of a point seen from the camera
+        or None if it is outside the field of view."""
+        dx, dy = x - self.x, y - self.y
+        horiz = math.hypot(dx, dy)
+        bearing = normalize(self.heading - math.degrees(math.atan2(dy, dx)))
+        if abs(bearing) > CAMERA_FOV:
+            return None
+        orient = 0.0
+        if facing is not None:
+            # Angle between the marker normal and the line back to the camera
+            orient = normalize(facing - math.degrees(math.atan2(-dy, -dx)))
+            if abs(orient) > MAX_VIEW_ANGLE:
+                return None
+        dist = math.hypot(horiz, CAMERA_HEIGHT - height)
+        return dist, bearing, orient
+
+    def see(self, res):
+        self.update()
+        self.captures += 1
+        scale = res[0] / 960.0
+        now = self.clock.time()
+        found = []
+
+        def add(code, marker_type, obs):
+            if obs is None:
+                return
+            dist, rot_y, orient = obs
+            max_range = RANGE_PER_METER * MARKER_SIZE[marker_type] * scale
+            if dist > max_range or self.rand.random() < 0.03:
+                return
+            dist *= 1 + self.rand.gauss(0, 0.015)
+            rot_y += self.rand.gauss(0, 0.7)
+            found.append(SimMarker(code, marker_type, dist, rot_y, orient, res,
+                                   now))
+
+        for code, marker_type, x, y, facing in self.markers:
+            add(code, marker_type, self._observe(x, y, MARKER_HEIGHT[marker_type],
+                                                 facing))
+        for code, x, y in self.robots:
+            add(code, MARKER_ROBOT, self._observe(x, y, MARKER_HEIGHT[MARKER_ROBOT]))
+        for token in self.tokens:
+            if token.scored is not None:
+                continue
+            if token.held:
+                if self.servos[self.arm_slot] < self.arm[1] * 0.85:
+                    found.append(SimMarker(token.code, MARKER_TOKEN_BOTTOM, 0.25,
+                                           0.0, 0.0, res, now))
+                continue
+            if math.hypot(token.x - self.x, token.y - self.y) < TOKEN_MIN_DIST:
+                continue
+            # Pick the side face turned most towards the camera
+            to_cam = math.degrees(math.atan2(self.y - token.y, self.x - token.x))
+            face = token.yaw + 90 * round(normalize(to_cam - token.yaw) / 90.0)
+            fx = token.x + 0.05 * math.cos(math.radians(face))
+            fy = token.y + 0.05 * math.sin(math.radians(face))
+            add(token.code, MARKER_TOKEN_SIDE,
+                self._observe(fx, fy, MARKER_HEIGHT[MARKER_TOKEN_SIDE], face))
+        timings = self.capture_timings(res)
+        self.clock.sleep(sum(timings.values()))
+        return found, timings
+
+    def capture_timings(self, res):
+        pixels = res[0] * res[1] / float(960 * 720)
+        return {'cam': 0.04, 'yuyv': 0.03 + 0.12 * pixels,
+                'find_markers': 0.05 + 0.25 * pixels}
+
+    def scored(self):
+        return [t for t in self.tokens if t.scored is not None]
+
+
+class SimMotor(object):
+    def __init__(self, world, wheel):
+        self._world = world
+        self._wheel = wheel
+        self._power = 0
+
+    def _get_power(self):
+        return self._power
+
+    def _set_power(self, value):
+        self._power = value
+        if self._wheel is not None:
+            self._world.set_power(self._wheel, value)
+
+    power = property(_get_power, _set_power)
+
+
+class SimMotorBoard(object):
+    def __init__(self, world, left_channel, right_channel):
+        wheels = {left_channel: 'LEFT', right_channel: 'RIGHT'}
+        self.m0 = SimMotor(world, wheels.get(0))
+        self.m1 = SimMotor(world, wheels.get(1))
+
+
+class SimServoBoard(object):
+    def __init__(self, world):
+        self._world = world
+
+    def __getitem__(self, slot):
+        return self._world.get_servo(slot)
+
+    def __setitem__(self, slot, value):
+        self._world.set_servo(slot, value)
+
+
+class SimRuggeduino(object):
+    def __init__(self, world, inputs):
+        self._world = world
+        self._inputs = inputs
+        self._modes = {}
+        self._outputs = {}
+
+    def _is_srduino(self):
+        return True
+
+    def pin_mode(self, pin, mode):
+        self._modes[pin] = mode
+
+    def digital_read(self, pin):
+        if pin in self._inputs:
+            # Inputs are pulled up, the switch pulls them low
+            return not self._inputs[pin]()
+        return self._modes.get(pin) == INPUT_PULLUP
+
+    def digital_write(self, pin, value):
+        self._outputs[pin] = value
+
+    def analogue_read(self, pin):
+        return 0.0
+
+
+class SimRobot(object):
+    def __init__(self, world, usbkey=None):
+        from motor_controller import MOTOR_MAP
+        from servo_controller import SERVO_MAP
+        from ruggeduino_controller import PIN_MAP
+        self.world = world
+        self.zone = world.corner
+        self.usbkey = usbkey or tempfile.mkdtemp(prefix='sim_usb')
+        self.power = _Struct(battery=_Struct(voltage=12.4, current=1.0))
+        model, serial, channels = MOTOR_MAP['WHEELS']
+        self.motors = {serial: SimMotorBoard(world, channels['LEFT']['channel'],
+                                             channels['RIGHT']['channel'])}
+        self.servos = [SimServoBoard(world)]
+        arm, grabber = SERVO_MAP['ARM'], SERVO_MAP['GRABBER']
+        world.register_servos(arm[3], grabber[3], arm[:2], grabber[:2])
+        sensor = world.read_token_sensor
+        serial, pins = PIN_MAP['SENSOR']
+        self.ruggeduinos = {serial: SimRuggeduino(world, dict(
+            (pin, sensor) for pin in pins.values()))}
+
+    @classmethod
+    def setup(cls):
+        raise RuntimeError("Use run_match() to set up a simulated robot")
+
+    def init(self):
+        pass
+
+    def wait_start(self):
+        pass
+
+    def see(self, res=(800, 600), stats=False):
+        markers, timings = self.world.see(res)
+        if stats:
+            return markers, timings
+        return markers
+
+
+def install():
+    """Register the simulated backend as the sr modules."""
+    if 'sr' in sys.modules and getattr(sys.modules['sr'], 'SIMULATED', False):
+        return
+    constants = dict((name, globals()[name]) for name in [
+        'MARKER_ARENA', 'MARKER_ROBOT', 'MARKER_TOKEN_TOP',
+        'MARKER_TOKEN_BOTTOM', 'MARKER_TOKEN_SIDE', 'MARKER_SLOT'])
+    sr = types.ModuleType('sr')
+    vision = types.ModuleType('sr.vision')
+    robot = types.ModuleType('sr.robot')
+    ruggeduino = types.ModuleType('sr.ruggeduino')
+    for module in (sr, vision, robot):
+        module.__dict__.update(constants)
+    ruggeduino.INPUT, ruggeduino.OUTPUT = INPUT, OUTPUT
+    ruggeduino.INPUT_PULLUP = INPUT_PULLUP
+    sr.INPUT, sr.OUTPUT, sr.INPUT_PULLUP = INPUT, OUTPUT, INPUT_PULLUP
+    robot.Robot = sr.Robot = SimRobot
+    sr.vision, sr.robot, sr.ruggeduino = vision, robot, ruggeduino
+    sr.SIMULATED = True
+    sys.modules.update({'sr': sr, 'sr.vision': vision, 'sr.robot': robot,
+                        'sr.ruggeduino': ruggeduino})
+
+
+def run_match(corner=0, seed=0, quiet=False, opponents=True, sim_clock=None,
+              record=None, profile=False, test=None):
+    """Play a full simulated match, returns the world at the end of it.
+    Runs on a virtual clock unless another clock is given. The match is
+    recorded to the record path if given, and profiled if profile is set.
+    If test is given the tests.py function of that name is run instead of
+    the game, on the real clock unless another is given, as tests can use
+    threads the virtual clock doesn't keep time for."""
+    install()
+    import clock
+    import recorder
+    import robot
+    import calibration
+    import IOInterface
+    import gamelogic
+    import profiler
+    if sim_clock is None:
+        sim_clock = clock.VirtualClock() if test is None else clock.RealClock()
+    old_clock = clock.set_clock(sim_clock)
+    world = World(sim_clock, corner, seed, opponents)
+    R = SimRobot(world)
+    logger = robot.setup_logger(R.usbkey)
+    calibration.load(R.usbkey)
+    if quiet:
+        logger.handlers[0].setLevel(logging.WARNING)
+    if record is not None:
+        recorder.start(record).match_start(corner)
+    if profile:
+        profiler.start()
+    try:
+        world.io = IOInterface.IOInterface(R)
+        if not isinstance(sim_clock, clock.VirtualClock):
+            world.io.start_sensors() # as robot.py does
+        if test is not None:
+            import tests
+            tests.run(logger, world.io, R, test)
+        else:
+            gamelogic.PlayGame(logger, world.io, corner, world.start)
+    except MatchOver:
+        pass
+    finally:
+        if hasattr(world, 'io'):
+            world.io.stop_sensors()
+        recorder.stop()
+        profiler.stop()
+        clock.set_clock(old_clock)
+        for handler in logger.handlers[:]:
+            handler.close()
+            logger.removeHandler(handler)
+    return world
+
+
+if __name__ == '__main__':
+    import time
+    import argparse
+    parser = argparse.ArgumentParser(description="Simulate a match")
+    parser.add_argument('--corner', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scale', type=float, default=None,
+                        help="Run on a real clock sped up by this factor")
+    parser.add_argument('--no-opponents', action='store_true')
+    parser.add_argument('--record', metavar='PATH',
+                        help="Record the match to PATH")
+    parser.add_argument('--profile', action='store_true',
+                        help="Log the time spent in each state")
+    parser.add_argument('--quiet', action='store_true')
+    parser.add_argument('--test', metavar='NAME',
+                        help="Run the tests.py function NAME instead")
+    args = parser.parse_args()
+    sim_clock = None
+    if args.scale is not None:
+        import clock
+        sim_clock = clock.ScaledClock(args.scale)
+    start = time.time()
+    world = run_match(args.corner, args.seed, args.quiet, not args.no_opponents,
+                      sim_clock, args.record, args.profile, args.test)
+    print "Simulated %.1fs in %.2fs, drove %.2fm, %d captures, scored %s" % (
+        world.clock.time() - world.start, time.time() - start, world.distance,
+        world.captures, [t.code for t in world.scored()])
+    print "Frame cache %s" % world.io.cache_stats
+    print world.io.camera.policy
+    world.io.camera.print_stat()
@@ -3,12 +3,33 @@
     A copy of the MIT License can be found in LICENSE.txt
 """
 
+"""
+Table driven state machine. The events a host can bind to are dispatched from
+a table built up front, changes of state are checked against the declared
+transitions, and each state can be given a time budget after which it is
+interrupted and the machine falls back to another state. A match deadline
+ends the machine whatever state it is in.
+"""
+
+import clock
+import recorder
+import profiler
+
+EVENTS = ('change', 'finish', 'error', 'interrupt', 'timeout')
+
+class TransitionError(Exception):
+    pass
+
 class State(object):
-    def __init__(self, name):
+    def __init__(self, name, budget=None, fallback=None):
         self.name = name
         self.listeners = []
         self.count = [0, 0, 0]
         self.was_interrupted = False
+        self.budget = budget # seconds the state may run for
+        # State to change to when the budget runs out, or a function
+        # returning its name
+        self.fallback = fallback
     def bind(self, action):
         if hasattr(action, '__call__'):
             self.listeners.append(action)
@@ -17,22 +38,30 @@ class State(object):
     def action(self, host, *args):
         self.was_interrupted = False
         errors = []
+        outcome = 'done'
+        prof = profiler.active()
+        if prof is not None:
+            prof.enter(self.name)
         for listener in self.listeners:
             try:
                 listener(*args)
                 self.count[0] += 1
             except StateInterrupt as si:
                 self.was_interrupted = True
-                host.notify_handler('interrupt', [self, si])
                 self.count[2] += 1
+                outcome = si.id
+                host.state_interrupted(self, si)
             except Exception as e:
                 errors.append({'listener':listener, 'exception':e})
                 self.count[1] += 1
         if len(errors) > 0:
+            outcome = 'error'
             host.notify_handler('error', [self, errors])
             host.active_state = None
         else:
             host.state_finished(self)
+        if prof is not None:
+            prof.leave(outcome)
     def __str__(self):
         return "<State %r [L:%d,C:%d,E:%d,I:%d]>" % (
             self.name, len(self.listeners), self.count[0], self.count[1],
@@ -43,6 +72,7 @@ class State(object):
 class StateRegister:
     def __init__(self):
         self.states = [[], {}]
+        self.transitions = None # name: names it can change to, None for any
     def register_state(self, state):
         if isinstance(state, State):
             self.states[0].append(state)
@@ -54,32 +84,66 @@ class StateRegister:
     def bind_states(self, state_dict):
         for name, func in state_dict.iteritems():
             self.get_state(name).bind(func)
+    def set_transitions(self, transitions):
+        """Declare the states each state can change to. A fallback given as a
+        name is always allowed."""
+        names = self.states[1]
+        for name, targets in transitions.iteritems():
+            for target in (name,) + tuple(targets):
+                if target not in names:
+                    raise TransitionError("Unknown state %r in transitions"
+                                          % target)
+        missing = set(names) - set(transitions)
+        if missing:
+            raise TransitionError("No transitions declared for %s"
+                                  % ", ".join(sorted(missing)))
+        self.transitions = {}
+        for name, targets in transitions.iteritems():
+            allowed = set(targets)
+            fallback = names[name].fallback
+            if isinstance(fallback, basestring):
+                allowed.add(fallback)
+            self.transitions[name] = frozenset(allowed)
+    def allowed(self, source, target):
+        if self.transitions is None or source is None:
+            return True
+        return target in self.transitions[source]
 
 class StateObserver:
     def __init__(self, stateregister):
-        self.handlers = []
+        self.handlers = dict((event, []) for event in EVENTS)
         self.register = stateregister
         self.active_state = None
+        self.entered = None # when the active state was changed to
+        self.match_end = None
+        self.match_time = None
 
     def bind(self, event, callback):
-        if event in ['change', 'finish', 'error', 'interrupt']:
-            self.handlers.append((event, callback))
+        if event not in self.handlers:
+            raise ValueError("Unknown event %r" % event)
+        self.handlers[event].append(callback)
 
     def get_register(self):
         return self.register
 
     def notify_handler(self, event, args=[]):
-        for h in self.handlers:
-            if h[0] == event:
-                try:
-                    h[1].__call__(*args)
-                except Exception, e:
-                    print e
+        for callback in self.handlers[event]:
+            try:
+                callback(*args)
+            except Exception, e:
+                print e
 
     def change_state(self, state):
         state.action(self, *self.active_state_args)
 
     def set_state(self, name, args=[]):
+        source = self.active_state
+        if not self.register.allowed(source and source.name, name):
+            raise TransitionError("%s can not change to %s" % (source.name,
+                                                               name))
+        self._enter(name, args)
+
+    def _enter(self, name, args):
         state = self.register.get_state(name)
         self.notify_handler('change', [self.active_state, state])
         if self.active_state is not None:
@@ -87,12 +151,62 @@ class StateObserver:
             print "[SM] State replaced"
         self.active_state = state
         self.active_state_args = args
+        self.entered = clock.time()
+        rec = recorder.active()
+        if rec is not None:
+            rec.state(name, args)
+        prof = profiler.active()
+        if prof is not None:
+            prof.changed(name)
 
     def state_finished(self, state):
         if state == self.active_state and not state.was_interrupted:
             self.notify_handler('finish', [state])
             self.active_state = None
 
+    def state_interrupted(self, state, interrupt):
+        if interrupt.id != 'deadline':
+            self.notify_handler('interrupt', [state, interrupt])
+            return
+        if self.match_end is not None and clock.time() >= self.match_end:
+            fallback = None
+        else:
+            fallback = state.fallback
+            if hasattr(fallback, '__call__'):
+                fallback = fallback()
+        self.notify_handler('timeout', [state, fallback])
+        if fallback is None:
+            self.active_state = None
+        else:
+            self._enter(fallback, [])
+
+    def start_match(self, seconds, start=None):
+        """End the machine seconds after start, or from now."""
+        if start is None:
+            start = clock.time()
+        self.match_time = seconds
+        self.match_end = start + seconds
+
+    def deadline(self):
+        """Returns the clock time the active state has to be interrupted at,
+        or None if there is no limit."""
+        times = []
+        if self.match_end is not None:
+            times.append(self.match_end)
+        state = self.active_state
+        if state is not None and state.budget is not None:
+            times.append(self.entered + state.budget)
+        return min(times) if times else None
+
+    def report(self, log):
+        """Log the profile of the states run so far, if profiling."""
+        prof = profiler.active()
+        if prof is not None:
+            start = None
+            if self.match_end is not None:
+                start = self.match_end - self.match_time
+            prof.report(log, start)
+
     def get_active_state(self):
         return self.active_state
 
@@ -108,9 +222,16 @@ class StateInterrupt(Exception):
         self.id = id
         self.args = args
 
-def StateMachine(states_dict):
+def StateMachine(states_dict, transitions=None, budgets={}):
+    """Returns the StateObserver of the states {name: function}. transitions
+    is {name: names it can change to}, budgets {name: (seconds, fallback)}."""
     register = StateRegister()
     for name, fn in states_dict.iteritems():
-        register.register_state(State(name).bind(fn))
+        register.register_state(State(name, *budgets.get(name, ())).bind(fn))
+    for name, budget in budgets.iteritems():
+        for target in (name,) + tuple(budget[1:]):
+            if isinstance(target, basestring) and target not in states_dict:
+                raise TransitionError("Unknown state %r in budgets" % target)
+    if transitions is not None:
+        register.set_transitions(transitions)
     return StateObserver(register)
-    
\ No newline at end of file
@@ -0,0 +1,66 @@
+"""
+    This file is part of Team Brocket Robotics, licensed under the MIT License.
+    A copy of the MIT License can be found in LICENSE.txt
+"""
+
+import math
+
+class Histogram(object):
+    """Fixed memory histogram of durations in seconds. Buckets grow
+    geometrically so quantiles are accurate to within the growth factor."""
+
+    def __init__(self, low=0.001, high=30.0, growth=1.05):
+        self.low = low
+        self._log_growth = math.log(growth)
+        self.buckets = [0] * (int(math.log(high / low) / self._log_growth) + 2)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        if value <= self.low:
+            index = 0
+        else:
+            index = int(math.log(value / self.low) / self._log_growth) + 1
+            index = min(index, len(self.buckets) - 1)
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+    def quantile(self, q):
+        """Returns the value below which a fraction q of the values fall."""
+        if self.count == 0:
+            return None
+        target = q * self.count
+        seen = 0
+        for index, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target and n > 0:
+                if index == 0:
+                    value = self.low
+                else:
+                    value = self.low * math.exp(index * self._log_growth)
+                return max(self.min, min(self.max, value))
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count, 'mean': self.mean(), 'max': self.max,
+                'p50': self.quantile(0.5), 'p95': self.quantile(0.95),
+                'p99': self.quantile(0.99)}
+
+    def __str__(self):
+        if self.count == 0:
+            return "n=0"
+        return "n=%d mean=%.3f p50=%.3f p95=%.3f p99=%.3f max=%.3f" % (
+            self.count, self.mean(), self.quantile(0.5), self.quantile(0.95),
+            self.quantile(0.99), self.max)
@@ -5,6 +5,7 @@
 
 from sr import *
 
+import clock
 from IOInterface import *
 
 def chassis_test():
@@ -47,7 +48,7 @@ def goto_tokens():
     io.move_arm(DOWN)
     down = True
     while True:
-        m = io.get_markers(MarkerFilter.include('TOKENS'))
+        m = io.get_markers(MarkerFilter.include('TOKENS'), fresh=True)
         if len(m) > 0:
             io.navigate_to_marker(io.get_closest_marker_rotation(m), 70,
                                   comparator=lambda a, b: a.info.code == b.info.code)
@@ -69,13 +70,13 @@ def calcualte_rpm():
     for i in range(5):
         m = []
         while len(m) == 0:
-            m = io.get_markers()
+            m = io.get_markers(fresh=True)
         m = io.get_closest_marker_rotation(m)
         start_dist = m.dist
         io.drive(Time(time, speed))
         m = []
         while len(m) == 0:
-            m = io.get_markers()
+            m = io.get_markers(fresh=True)
         m = io.get_closest_marker_rotation(m)
         traveled = start_dist - m.dist
         rpm.append(io.left_wheel.calc_rpm(time, traveled, speed))
@@ -86,6 +87,13 @@ def calcualte_rpm():
         t+=r
     log.info("AVG = %f", (t/5.0))
 
+def calibrate_motors():
+    import calibration
+    tables = calibration.calibrate(io, R.usbkey)
+    for key, table in sorted(tables.items()):
+        log.info("%s: %s", key, table.to_list())
+    log.info("Odometry noise: %s", calibration.odometry_noise())
+
 def calcualte_rpm2():
     io.drive(Distance(1, 100))
 
@@ -113,7 +121,63 @@ def interrupt_test():
         io.wait(1)
         io._stop_operation()
     threading.Thread(target=interrupt).start()
-    io.drive(Distance(10, 100))
+    d = Distance(10, 100)
+    try:
+        io.drive(d)
+    except StateInterrupt:
+        log.info("Stopped after %.2f meters", d.covered)
+
+def stop_latency_test():
+    """A stop from another thread has to cut the motors and wake the control
+    thread from its wait within STOP_LATENCY."""
+    import threading
+    times = {}
+    def interrupt():
+        io.wait(1)
+        times['request'] = clock.time()
+        io._stop_operation()
+        times['motors'] = clock.time()
+    threading.Thread(target=interrupt).start()
+    d = Distance(10, 100)
+    try:
+        io.drive(d)
+    except StateInterrupt:
+        times['woke'] = clock.time()
+    motors = times['motors'] - times['request']
+    woke = times['woke'] - times['request']
+    log.info("Motors stopped after %.1fms, control thread woke after %.1fms, "
+             "%.2f meters driven", 1000 * motors, 1000 * woke, d.covered)
+    assert motors <= STOP_LATENCY, "Motors stopped too late"
+    assert woke <= STOP_LATENCY, "Control thread woke too late"
+
+def sensor_test():
+    """Start with a token in the open grabber. Backing away and driving up
+    again has to give one debounced edge each way from the sensor service,
+    and cached reads that agree."""
+    edges = []
+    def edge(name):
+        return lambda sensor: edges.append((name, sensor))
+    sensors = [io.token_sensL, io.token_sensR]
+    for sensor in sensors:
+        io.sensors.register(sensor, debounce=0.05, on_rise=edge('in'),
+                            on_fall=edge('out'))
+    io.start_sensors()
+    io.open_grabber(True)
+    io.wait(0.5)
+    assert io.is_holding_token(), "No token in the grabber"
+    io.drive(Distance(-0.4, 40))
+    io.wait(0.5)
+    assert not io.is_holding_token(), "Token still seen"
+    io.drive(Distance(0.4, 40))
+    io.wait(0.5)
+    assert io.is_holding_token(), "Token not seen again"
+    for sensor in sensors:
+        value, timestamp = io.sensors.last_read(sensor)
+        assert clock.time() - timestamp <= io.sensors.max_age, "Not polled"
+        seen = [name for name, s in edges if s is sensor]
+        log.info("%s edges %s", sensor, seen)
+        assert seen == ['out', 'in'], "Expected one edge each way"
+    log.info("%d polls", io.sensors.polls)
 
 def token_test():
     def check():
@@ -132,15 +196,34 @@ def token_test():
         io.open_grabber()    
         io.drive(Distance(-0.5, 50))
 
-def run(log_, io_, R_):
+def pose_test():
+    while True:
+        found = io.get_pose(io.get_markers(fresh=True))
+        if found is None:
+            log.info("Can't see enough arena markers")
+        else:
+            log.info("At (%.2f, %.2f) heading %.1f, %d markers, error %.3fm",
+                     found.x, found.y, found.heading, found.count, found.error)
+        io.wait(1)
+
+def run(log_, io_, R_, test=None):
+    """Run the test function named test, or the one picked below."""
     global log, io, R
     log, io, R  = log_, io_, R_
+    if test is not None:
+        globals()[test]()
+        log.info("Finish execution")
+        return
     #chassis_test()
     #servo_test()
     #bump_test()
     #interrupt_test()
+    #stop_latency_test()
     goto_tokens()
     #vision_test(R)
     #calcualte_rpm()
+    #calibrate_motors()
     #token_test()
+    #sensor_test()
+    #pose_test()
     log.info("Finish execution")
@@ -5,6 +5,8 @@
 
 import threading
 
+import clock
+
 class ThreadRegister:
     def __init__(self, io):
         self.threads = {}
@@ -16,20 +18,33 @@ class ThreadRegister:
         thread.daemon = True
         thread.setup()
     def check_running_state(self, thread):
-        return True
+        return self.io.running
 
 class Runnable(threading.Thread):
     def setup(self):
         pass
 
-class BumpThread(Runnable):
+class SensorThread(Runnable):
+    def setup(self):
+        self.name = "sensor_thread"
+        self.sensors = self.io.sensors
+    def run(self):
+        while self.reg.check_running_state(self) and self.sensors.polling:
+            start = clock.time()
+            try:
+                self.sensors.poll()
+            except Exception as e:
+                self.io.log.exception(e)
+            clock.sleep(self.sensors.interval - (clock.time() - start))
+
+class CaptureThread(Runnable):
     def setup(self):
-        self.name = "bump_thread"
-        self.sensors = [self.io.bump_FrL, self.io.bump_FrR,
-                        self.io.bump_BkL, self.io.bump_BkR]
+        self.name = "capture_thread"
+        self.camera = self.io.camera
     def run(self):
-        while self.reg.check_running_state(self):
-            for sensor in self.sensors:
-                if sensor.read():
-                    self.io.bumped(sensor)
-            self.io.wait(0.2)
+        while self.reg.check_running_state(self) and self.camera.capturing:
+            try:
+                self.camera.capture()
+            except Exception as e:
+                self.io.log.exception(e)
+                clock.sleep(0.5)
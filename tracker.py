@@ -0,0 +1,167 @@
+"""
+    This file is part of Team Brocket Robotics, licensed under the MIT License.
+    A copy of the MIT License can be found in LICENSE.txt
+"""
+
+"""
+Extended Kalman filter keeping track of the robot pose between scans. Every
+movement is fed in as the distance each wheel went (the odometry of the
+MoveInstruction, from the motor model), which moves the estimate and grows its
+uncertainty. The range and bearing of every arena or slot marker seen shrinks
+it again. If the markers stop agreeing with the estimate altogether the
+tracker jumps to the pose solved from them.
+"""
+
+import math
+
+import pose
+import calibration
+
+# The wheels mostly go wrong together, so the odometry noise is on the
+# distance, the turn and the heading straights wander off by (see
+# calibration.ODOMETRY_NOISE) with only a little on each wheel.
+WHEEL_NOISE = 0.005 # meters of standard deviation added per movement
+RANGE_NOISE = 0.03 # standard deviation per meter of range
+BEARING_NOISE = math.radians(1.5)
+GATE = 9.21 # chi squared, 2 degrees of freedom at 99%
+START_NOISE = (0.1, 0.1, math.radians(5))
+
+def _mul(a, b):
+    return [[sum(a[i][k] * b[k][j] for k in range(len(b)))
+             for j in range(len(b[0]))] for i in range(len(a))]
+
+def _transpose(a):
+    return map(list, zip(*a))
+
+def _add(a, b):
+    return [[x + y for x, y in zip(ra, rb)] for ra, rb in zip(a, b)]
+
+def _inverse2(a):
+    det = a[0][0] * a[1][1] - a[0][1] * a[1][0]
+    return [[a[1][1] / det, -a[0][1] / det], [-a[1][0] / det, a[0][0] / det]]
+
+def _diagonal(values):
+    return [[v if i == j else 0.0 for j, v in enumerate(values)]
+            for i in range(len(values))]
+
+def _wrap(angle):
+    """Wrap radians into -pi to pi."""
+    return (angle + math.pi) % (2 * math.pi) - math.pi
+
+class PoseTracker(object):
+    def __init__(self, x, y, heading, span, noise=START_NOISE, odometry=None):
+        self.span = span # meters between the wheels
+        # Standard deviations by name as in calibration.ODOMETRY_NOISE
+        self.odometry = odometry or calibration.odometry_noise()
+        self.reset(x, y, heading, noise)
+        self.updates = 0
+        self.rejected = 0
+        self.resets = 0
+        self.timestamp = None
+
+    def reset(self, x, y, heading, noise=START_NOISE):
+        """Start again from a pose (heading in degrees) with the standard
+        deviations noise of (x, y, heading radians)."""
+        self.state = [float(x), float(y), math.radians(heading)]
+        self.cov = _diagonal([n ** 2 for n in noise])
+
+    def predict(self, left, right):
+        """Move the estimate by the meters each wheel went."""
+        x, y, h = self.state
+        dist = (left + right) / 2.0
+        span = self.span
+        turn = (right - left) / span # anticlockwise
+        mid = h + turn / 2
+        cos, sin = math.cos(mid), math.sin(mid)
+        self.state = [x + dist * cos, y + dist * sin, _wrap(h + turn)]
+        jacobian = [[1, 0, -dist * sin], [0, 1, dist * cos], [0, 0, 1]]
+        noise = self.odometry
+        drift = noise['drift' if dist >= 0 else 'reverse_drift']
+        var_dist = (noise['distance'] * dist) ** 2 + WHEEL_NOISE ** 2
+        var_turn = ((noise['turn'] * turn) ** 2 + (drift * dist) ** 2 +
+                    (WHEEL_NOISE / span) ** 2)
+        # The distance and turn noise against x, y and heading
+        motion = [[cos, -dist * sin / 2], [sin, dist * cos / 2], [0, 1]]
+        self.cov = _add(_mul(_mul(jacobian, self.cov), _transpose(jacobian)),
+                        _mul(_mul(motion, _diagonal([var_dist, var_turn])),
+                             _transpose(motion)))
+
+    def correct(self, markers):
+        """Update from the fixed markers in a frame. Returns the number of
+        markers used."""
+        used = rejected = 0
+        for marker in markers:
+            world = pose.world_position(marker)
+            if world is None:
+                continue
+            if self._update(world, marker):
+                used += 1
+            else:
+                rejected += 1
+        self.rejected += rejected
+        if rejected >= 2 and used == 0:
+            # Lost, start again from the markers if they agree among themselves
+            fix = pose.solve(markers)
+            if fix is not None:
+                spread = max(fix.error, 0.05)
+                self.reset(fix.x, fix.y, fix.heading,
+                           (spread, spread, math.radians(3)))
+                self.resets += 1
+                used = fix.count
+        if used and markers:
+            self.timestamp = getattr(markers, 'timestamp', None)
+        return used
+
+    def _update(self, world, marker):
+        x, y, h = self.state
+        dx, dy = world[0] - x, world[1] - y
+        r2 = dx ** 2 + dy ** 2
+        r = math.sqrt(r2)
+        if r < 0.1:
+            return False
+        local_x, local_y = pose.relative_position(marker)
+        innovation = [math.hypot(local_x, local_y) - r,
+                      _wrap(math.radians(marker.rot_y) -
+                            (h - math.atan2(dy, dx)))]
+        # Range and bearing (to the right) against x, y and heading
+        H = [[-dx / r, -dy / r, 0], [-dy / r2, dx / r2, 1]]
+        R = _diagonal([(RANGE_NOISE * r) ** 2, BEARING_NOISE ** 2])
+        S = _add(_mul(_mul(H, self.cov), _transpose(H)), R)
+        S_inv = _inverse2(S)
+        distance = sum(innovation[i] * S_inv[i][j] * innovation[j]
+                       for i in range(2) for j in range(2))
+        if distance > GATE:
+            return False
+        K = _mul(_mul(self.cov, _transpose(H)), S_inv)
+        for i in range(3):
+            self.state[i] += sum(K[i][j] * innovation[j] for j in range(2))
+        self.state[2] = _wrap(self.state[2])
+        KH = _mul(K, H)
+        self.cov = _mul([[float(i == j) - KH[i][j] for j in range(3)]
+                         for i in range(3)], self.cov)
+        self.updates += 1
+        return True
+
+    @property
+    def error(self):
+        """Meters, the standard deviation of the position along its worst
+        direction."""
+        a, b, c = self.cov[0][0], self.cov[1][1], self.cov[0][1]
+        return math.sqrt((a + b) / 2 + math.sqrt(((a - b) / 2) ** 2 + c ** 2))
+
+    @property
+    def pose(self):
+        x, y, h = self.state
+        return pose.Pose(x, y, math.degrees(h), self.error, 0, self.timestamp)
+
+    def covariance(self):
+        """Returns the 3x3 covariance of (x, y, heading in radians)."""
+        return [row[:] for row in self.cov]
+
+    def __str__(self):
+        x, y, h = self.state
+        return "(%.2f, %.2f) heading %.1f +-%.2fm %.1fdeg, %d updates, " \
+            "%d rejected, %d resets" % (x, y, math.degrees(h), self.error,
+                                        math.degrees(math.sqrt(self.cov[2][2])),
+                                        self.updates, self.rejected,
+                                        self.resets)
@@ -0,0 +1,84 @@
+"""
+    This file is part of Team Brocket Robotics, licensed under the MIT License.
+    A copy of the MIT License can be found in LICENSE.txt
+"""
+
+"""
+Online estimate of how far turns really go. Whenever markers are seen just
+before and just after a turn (and nothing else moved) the change in their
+bearing is the angle actually turned. The ratio to the angle asked for is kept
+per pivot and speed, and later turns are scaled by it.
+"""
+
+import collections
+
+SPEED_STEP = 10 # % speed covered by each bucket of samples
+WINDOW = 15 # samples kept per bucket
+MIN_SAMPLES = 3 # samples needed before a bucket is used
+MIN_TURN = 4.0 # degrees, smaller turns are swamped by bearing noise
+MIN_MARKER_DIST = 1.0 # meters, nearer markers shift with the camera
+GAIN_RANGE = (0.5, 1.5) # ratios outside this are taken as bad matches
+MAX_DEVIATION = 3.0 # outlier cut off, in median absolute deviations
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+class TurnGain(object):
+    def __init__(self):
+        self.samples = {} # (pivot, speed bucket): deque of gains
+        self.rejected = 0
+
+    def _key(self, speed, pivot):
+        return pivot, int(round(abs(speed) / float(SPEED_STEP))) * SPEED_STEP
+
+    def gain(self, speed, pivot):
+        """Returns the fraction of the asked for angle a turn actually goes,
+        from the nearest speed with enough samples, or 1 if there is none."""
+        key = self._key(speed, pivot)
+        usable = [k for k, v in self.samples.items()
+                  if k[0] == pivot and len(v) >= MIN_SAMPLES]
+        if not usable:
+            return 1.0
+        nearest = min(usable, key=lambda k: abs(k[1] - key[1]))
+        return median(self.samples[nearest])
+
+    def observe(self, speed, pivot, asked, turned):
+        """Record that a turn of asked degrees (before any correction) really
+        turned by the turned degrees. Returns False if the sample was
+        rejected."""
+        if abs(asked) < MIN_TURN:
+            return False
+        gain = turned / asked
+        bucket = self.samples.setdefault(self._key(speed, pivot),
+                                         collections.deque(maxlen=WINDOW))
+        if not GAIN_RANGE[0] <= gain <= GAIN_RANGE[1]:
+            self.rejected += 1
+            return False
+        if len(bucket) >= MIN_SAMPLES:
+            middle = median(bucket)
+            spread = max(0.03, median(abs(g - middle) for g in bucket))
+            if abs(gain - middle) > MAX_DEVIATION * spread:
+                self.rejected += 1
+                return False
+        bucket.append(gain)
+        return True
+
+    def bearing_change(self, before, after):
+        """Returns the median change in bearing (degrees to the right) of the
+        markers seen far enough away in both lists, or None."""
+        old = dict((m.info.code, m) for m in before
+                   if m.dist >= MIN_MARKER_DIST)
+        changes = [m.rot_y - old[m.info.code].rot_y for m in after
+                   if m.info.code in old and m.dist >= MIN_MARKER_DIST]
+        if not changes:
+            return None
+        return median(changes)
+
+    def __str__(self):
+        return ", ".join("%s@%d%%: %.3f (n=%d)" % (k[0], k[1], median(v), len(v))
+                         for k, v in sorted(self.samples.items()) if v) or \
+            "no samples"
@@ -4,7 +4,12 @@
 """
 
 import math
+import bisect
+import threading
 
+import clock
+import recorder
+from stats import Histogram
 from sr.vision import (MARKER_ARENA,
                        MARKER_ROBOT,
                        MARKER_SLOT,
@@ -13,6 +18,12 @@ from sr.vision import (MARKER_ARENA,
                        MARKER_TOKEN_SIDE)
 
 DEFAULT_RESOLUTION = (960, 720)
+RESOLUTIONS = [(320, 240), (640, 480), DEFAULT_RESOLUTION]
+DETECT_RANGE = 2.6 # Meters a token or slot is found at with DEFAULT_RESOLUTION
+DISTANCE_BUCKETS = [0.5, 1.0, 1.5, 2.0, 3.0]
+MISS_PENALTY = 5.0 # Seconds lost when the target is missed (re-search)
+# Stat name: key in the timings returned by robot.see
+TIMINGS = {'cam_init': 'cam', 'capture': 'yuyv', 'img_scan': 'find_markers'}
 
 MARKER_FILTERS = {
     'TOKENS': [MARKER_TOKEN_TOP, MARKER_TOKEN_BOTTOM, MARKER_TOKEN_SIDE],
@@ -27,37 +38,118 @@ class VisionController(object):
     def __init__(self, robot):
         self.res = DEFAULT_RESOLUTION
         self._see = robot.see
-        self._stats = {
-            'cam_init': [],
-            'capture': [],
-            'img_scan': []
-        }
+        self._stats = self._new_stats()
+        self._res_stats = {} # res: stats of the captures at that resolution
+        self.policy = ResolutionPolicy()
+        self.capturing = False
+        self._latest = None # (timestamp, markers) of the newest capture
+        self._frame_ready = threading.Condition()
+        self._camera = threading.Lock() # one robot.see at a time
 
     def find_markers(self):
-        markers, timings = self._see(self.res, True)
-        self._record_timings(timings)
-        return markers
+        return self.capture()[1]
 
-    def _record_timings(self, times):
-        self._stats['cam_init'].append(times['cam'])
-        self._stats['capture'].append(times['yuyv'])
-        self._stats['img_scan'].append(times['find_markers'])
+    def capture(self, res=None):
+        """Capture and scan a frame, returns (timestamp, markers). The timestamp
+        is taken when the capture is started."""
+        res = res or self.res
+        with self._camera:
+            timestamp = clock.time()
+            markers, timings = self._see(res, True)
+        markers = MarkerFrame(markers, timestamp, res)
+        rec = recorder.active()
+        if rec is not None:
+            rec.frame(timestamp, res, markers, sum(timings.values()))
+        self._record_timings(timings, res)
+        self.policy.record_latency(res, sum(timings.values()))
+        self._frame_ready.acquire()
+        try:
+            if self._latest is None or timestamp >= self._latest[0]:
+                self._latest = (timestamp, markers)
+            self._frame_ready.notify_all()
+        finally:
+            self._frame_ready.release()
+        return timestamp, markers
+
+    def latest_frame(self, newer_than=None, timeout=None):
+        """Returns the newest (timestamp, markers) captured after newer_than.
+        In continuous capture mode this only waits if the newest frame is too
+        old, otherwise a frame is captured now. Returns None if the capture
+        thread is still running but gave no such frame within timeout seconds.
+        """
+        if timeout is not None:
+            deadline = clock.time() + timeout
+        self._frame_ready.acquire()
+        try:
+            while self.capturing and not self._newer(newer_than):
+                if timeout is None:
+                    self._frame_ready.wait()
+                    continue
+                left = deadline - clock.time()
+                if left <= 0:
+                    return None
+                self._frame_ready.wait(left)
+            frame = self._latest
+        finally:
+            self._frame_ready.release()
+        if self._newer(newer_than, frame):
+            return frame
+        # Not capturing, or the capture thread stopped while waiting. The
+        # camera lock keeps this from running alongside its last capture.
+        return self.capture()
+
+    def _newer(self, newer_than, frame=None):
+        frame = frame or self._latest
+        return frame is not None and (newer_than is None or
+                                      frame[0] > newer_than)
+
+    def stop_capture(self):
+        self._frame_ready.acquire()
+        self.capturing = False
+        self._frame_ready.notify_all()
+        self._frame_ready.release()
+
+    def _new_stats(self):
+        stats = dict((name, Histogram()) for name in TIMINGS)
+        stats['total'] = Histogram()
+        return stats
+
+    def _record_timings(self, times, res=None):
+        if res not in self._res_stats:
+            self._res_stats[res] = self._new_stats()
+        for stats in (self._stats, self._res_stats[res]):
+            for name, key in TIMINGS.items():
+                stats[name].add(times[key])
+            stats['total'].add(sum(times[key] for key in TIMINGS.values()))
+
+    def stats_snapshot(self):
+        """Returns the capture latency quantiles, overall and by resolution."""
+        snapshot = dict((name, hist.snapshot())
+                        for name, hist in self._stats.items())
+        snapshot['by_res'] = {}
+        for res, stats in self._res_stats.items():
+            snapshot['by_res']['%dx%d' % res] = dict(
+                (name, hist.snapshot()) for name, hist in stats.items())
+        return snapshot
+
+    def log_stats(self, log):
+        for res, stats in sorted(self._res_stats.items()):
+            log.info("Capture %dx%d: %s", res[0], res[1], stats['total'])
+        for name in sorted(self._stats):
+            log.info("Capture %s: %s", name, self._stats[name])
 
     def print_stat(self):
-        timesvars = [[]] * 3
-        timesvars[0] = self._stats['cam_init']
-        timesvars[1] = self._stats['capture']
-        timesvars[2] = self._stats['img_scan']
-        averages = []
-        for times in timesvars:
-            avg = 0
-            for time in times:
-                avg += time
-            avg /= float(len(times))
-            averages.append(avg)
-        print "It took %f seconds for camera to initialize" % averages[0]
-        print "It took %f seconds to capture the image" % averages[1]
-        print "It took %f seconds to scan for libkoki markers" % averages[2]
+        if self._stats['total'].count == 0:
+            print "No images have been captured"
+            return
+        print "It took %f seconds for camera to initialize" % (
+            self._stats['cam_init'].mean())
+        print "It took %f seconds to capture the image" % (
+            self._stats['capture'].mean())
+        print "It took %f seconds to scan for libkoki markers" % (
+            self._stats['img_scan'].mean())
+        for res, stats in sorted(self._res_stats.items()):
+            print "%dx%d capture latency %s" % (res[0], res[1], stats['total'])
 
     def change_resolution(self, new_res):
         if type(new_res) == tuple and len(new_res) == 2:
@@ -68,26 +160,12 @@ class VisionController(object):
 
     @classmethod
     def get_closest(self, markers):
-        if len(markers) == 0: return None
-        closest = markers[0]
-        for m in markers:
-            if m.dist < closest.dist:
-                closest = m
-        return closest
+        return ANY_MARKER.closest(markers)
 
     @classmethod
     def get_rotation_nearest(self, markers, degree=0):
         """Returns the marker closest to degree from a list of markers."""
-        if len(markers) == 0: return None
-        getrad = lambda d: math.radians(abs(d - 180))
-        if degree > 180: degree = degree - 360
-        target = getrad(degree)
-        closest = [math.pi, markers[0]]
-        for m in markers:
-            diff = abs(target - getrad(m.rot_y))
-            if diff < closest[0]:
-                closest = [diff, m]
-        return closest[1]
+        return ANY_MARKER.rotation_nearest(markers, degree)
 
     @classmethod
     def fmt_markers(self, markers):
@@ -98,24 +176,276 @@ class VisionController(object):
         return "Marker(code=%d, type=%d, dist=%f rot_y=%f orientation(rot_y=%f))" % (
             m.info.code, m.info.marker_type, m.dist, m.rot_y, m.orientation.rot_y)
 
+class MarkerFrame(list):
+    """The markers of one capture, indexed by type, by code and by type and
+    code. Behaves as the plain list of markers otherwise."""
+
+    def __init__(self, markers=(), timestamp=None, res=None):
+        list.__init__(self, markers)
+        self.timestamp = timestamp
+        self.res = res
+        self._types = {}
+        self._codes = {}
+        self._type_codes = {}
+        for m in self:
+            info = m.info
+            self._types.setdefault(info.marker_type, []).append(m)
+            self._codes.setdefault(info.code, []).append(m)
+            self._type_codes.setdefault((info.marker_type, info.code),
+                                        []).append(m)
+
+    def by_type(self, marker_type):
+        return self._types.get(marker_type, [])
+
+    def by_code(self, code):
+        return self._codes.get(code, [])
+
+    def get(self, marker_type, code):
+        return self._type_codes.get((marker_type, code), [])
+
+    def select(self, types=None, codes=None):
+        """Returns a frame of the markers with one of the types and codes
+        given, None matches any."""
+        if types is None and codes is None:
+            return self
+        found = []
+        if codes is None:
+            for marker_type in set(types):
+                found += self._types.get(marker_type, [])
+        elif types is None:
+            for code in set(codes):
+                found += self._codes.get(code, [])
+        else:
+            for marker_type in set(types):
+                for code in set(codes):
+                    found += self._type_codes.get((marker_type, code), [])
+        return MarkerFrame(found, self.timestamp, self.res)
+
+class ResolutionPolicy(object):
+    """Picks the capture resolution for a scan. Searches use the highest
+    resolution, scans for a marker at a known distance use the one with the
+    lowest expected cost, learnt from the capture timings and from whether the
+    marker was found at that distance."""
+
+    PRIOR_WEIGHT = 4 # How many scans the prior guess is worth
+    SMOOTHING = 0.2
+
+    def __init__(self, resolutions=RESOLUTIONS):
+        self.resolutions = sorted(resolutions, key=lambda r: r[0] * r[1])
+        self._latency = {} # res: moving average of the capture latency
+        self._results = {} # (res, distance bucket): [found, scans]
+
+    def choose(self, distance=None):
+        if distance is None:
+            return self.resolutions[-1]
+        return min(self.resolutions, key=lambda res: self.cost(res, distance))
+
+    def cost(self, res, distance):
+        miss = 1 - self.detect_probability(res, distance)
+        return self.expected_latency(res) + miss * MISS_PENALTY
+
+    def expected_latency(self, res):
+        if res in self._latency:
+            return self._latency[res]
+        pixels = res[0] * res[1]
+        if not self._latency:
+            return 0.5 * pixels / float(DEFAULT_RESOLUTION[0] *
+                                        DEFAULT_RESOLUTION[1])
+        # Scale from the known resolution nearest in pixel count
+        known = min(self._latency,
+                    key=lambda known: abs(known[0] * known[1] - pixels))
+        return self._latency[known] * pixels / float(known[0] * known[1])
+
+    def detect_probability(self, res, distance):
+        if distance <= DETECT_RANGE * res[0] / float(DEFAULT_RESOLUTION[0]):
+            prior = 0.95
+        else:
+            prior = 0.1
+        found, scans = self._results.get(self._key(res, distance), (0, 0))
+        return (found + prior * self.PRIOR_WEIGHT) / (scans + self.PRIOR_WEIGHT)
+
+    def record_latency(self, res, seconds):
+        if res not in self._latency:
+            self._latency[res] = seconds
+        else:
+            self._latency[res] += self.SMOOTHING * (seconds - self._latency[res])
+
+    def record_result(self, res, distance, found):
+        result = self._results.setdefault(self._key(res, distance), [0, 0])
+        result[0] += 1 if found else 0
+        result[1] += 1
+
+    def _key(self, res, distance):
+        return res, bisect.bisect_left(DISTANCE_BUCKETS, distance)
+
+    def __str__(self):
+        return "ResolutionPolicy(latency=%s, results=%s)" % (self._latency,
+                                                              self._results)
+
 class MarkerFilter:
+    _cache = {}
+
     @staticmethod
     def include(*types):
-        accept = []
-        for filter in types:
-            if filter.upper() in MARKER_FILTERS:
-                accept += MARKER_FILTERS[filter.upper()]
-        return accept
+        """Returns the frozenset of marker types in the named filters."""
+        key = ('include',) + types
+        if key not in MarkerFilter._cache:
+            accept = set()
+            for filter in types:
+                accept.update(MARKER_FILTERS.get(filter.upper(), []))
+            MarkerFilter._cache[key] = frozenset(accept)
+        return MarkerFilter._cache[key]
 
     @staticmethod
     def exclude(*types):
-        accept = []
-        for v in MARKER_FILTERS.values(): accept += v
-        for filter in types:
-            if filter.upper() in MARKER_FILTERS:
-                for m in MARKER_FILTERS[filter.upper()]:
-                    accept.remove(m)
-        return accept
+        """Returns the frozenset of marker types not in the named filters."""
+        key = ('exclude',) + types
+        if key not in MarkerFilter._cache:
+            MarkerFilter._cache[key] = (MarkerFilter.include(*MARKER_FILTERS) -
+                                        MarkerFilter.include(*types))
+        return MarkerFilter._cache[key]
+
+def _intersect(bounds, low, high):
+    """The (low, high) range inside both bounds and low to high, None for
+    no bound."""
+    if low is None or (bounds[0] is not None and bounds[0] > low):
+        low = bounds[0]
+    if high is None or (bounds[1] is not None and bounds[1] < high):
+        high = bounds[1]
+    return (low, high)
+
+class MarkerQuery(object):
+    """Declarative marker query, for example
+        MarkerQuery('TOKENS').codes(our_tokens).dist(high=0.5).closest(markers)
+    Each method returns a new query so queries can be kept and reused. Terms
+    combine, so chained ranges intersect and where conditions must all hold.
+    The conditions are compiled on first use into a single predicate."""
+
+    def __init__(self, *groups):
+        self._types = MarkerFilter.include(*groups) if groups else None
+        self._codes = None
+        self._dist = (None, None)
+        self._rot_y = (None, None)
+        self._where = ()
+        self._predicate = None
+
+    def _copy(self, **changes):
+        query = MarkerQuery()
+        query.__dict__.update(self.__dict__)
+        query.__dict__.update(changes)
+        query._predicate = None
+        return query
+
+    def types(self, *marker_types):
+        """Only match the marker types given (sr.vision constants)."""
+        types = frozenset(marker_types)
+        if self._types is not None:
+            types = types & self._types
+        return self._copy(_types=types)
+
+    def exclude(self, *groups):
+        types = self._types
+        if types is None:
+            types = MarkerFilter.include(*MARKER_FILTERS)
+        return self._copy(_types=types - MarkerFilter.include(*groups))
+
+    def codes(self, codes):
+        codes = frozenset(codes)
+        if self._codes is not None:
+            codes = codes & self._codes
+        return self._copy(_codes=codes)
+
+    def dist(self, low=None, high=None):
+        """Match markers with low <= dist < high."""
+        return self._copy(_dist=_intersect(self._dist, low, high))
+
+    def rot_y(self, low=None, high=None):
+        """Match markers with low <= rot_y < high."""
+        return self._copy(_rot_y=_intersect(self._rot_y, low, high))
+
+    def where(self, condition):
+        """Match markers for which condition(marker) is true as well."""
+        return self._copy(_where=self._where + (condition,))
+
+    def compile(self, ranges_only=False):
+        """Returns the predicate for a single marker. With ranges_only the
+        type and code conditions are left out."""
+        types = None if ranges_only else self._types
+        codes = None if ranges_only else self._codes
+        min_dist, max_dist = self._dist
+        min_rot, max_rot = self._rot_y
+        where = self._where
+        def predicate(m):
+            if types is not None and m.info.marker_type not in types:
+                return False
+            if codes is not None and m.info.code not in codes:
+                return False
+            if min_dist is not None and m.dist < min_dist:
+                return False
+            if max_dist is not None and m.dist >= max_dist:
+                return False
+            if min_rot is not None and m.rot_y < min_rot:
+                return False
+            if max_rot is not None and m.rot_y >= max_rot:
+                return False
+            for condition in where:
+                if not condition(m):
+                    return False
+            return True
+        return predicate
+
+    def all(self, markers):
+        """Returns the list of matching markers."""
+        if isinstance(markers, MarkerFrame) and (self._types is not None or
+                                                 self._codes is not None):
+            markers = markers.select(self._types, self._codes)
+            if self._dist == self._rot_y == (None, None) and not self._where:
+                return markers
+            predicate = self._ranges_predicate()
+        else:
+            predicate = self._full_predicate()
+        return [m for m in markers if predicate(m)]
+
+    def _full_predicate(self):
+        if self._predicate is None:
+            self._predicate = (self.compile(), self.compile(True))
+        return self._predicate[0]
+
+    def _ranges_predicate(self):
+        self._full_predicate()
+        return self._predicate[1]
+
+    def first(self, markers):
+        for m in self.all(markers):
+            return m
+        return None
+
+    def any(self, markers):
+        return self.first(markers) is not None
+
+    def closest(self, markers):
+        """Returns the matching marker with the smallest distance."""
+        closest = None
+        for m in self.all(markers):
+            if closest is None or m.dist < closest.dist:
+                closest = m
+        return closest
+
+    def rotation_nearest(self, markers, degree=0):
+        """Returns the matching marker with rot_y closest to degree."""
+        markers = self.all(markers)
+        if len(markers) == 0: return None
+        getrad = lambda d: math.radians(abs(d - 180))
+        if degree > 180: degree = degree - 360
+        target = getrad(degree)
+        closest = [math.pi, markers[0]]
+        for m in markers:
+            diff = abs(target - getrad(m.rot_y))
+            if diff < closest[0]:
+                closest = [diff, m]
+        return closest[1]
+
+ANY_MARKER = MarkerQuery()
 
 class Marker:
     # A marker helper class
@@ -157,8 +487,9 @@ class Marker:
 
 class Token:
     def __init__(self, markers):
-        filt = MarkerFilter.include('TOKENS')
-        markers = filter(lambda m: m.info.marker_type in filt, markers)
+        if not isinstance(markers, MarkerFrame):
+            markers = MarkerFrame(markers)
+        markers = markers.select(MarkerFilter.include('TOKENS'))
         self.top = self.bottom = None
         self.sides = []
         for marker in markers:
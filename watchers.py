@@ -3,28 +3,172 @@
     A copy of the MIT License can be found in LICENSE.txt
 """
 
+"""
+What has been seen around the arena. Every token, robot and fixed marker in a
+frame is put at its arena position, from the tracked pose of the robot when the
+frame was taken. Confidence in where something is halves every half life after
+it was last placed, as tokens get moved and robots drive about.
+"""
+
+import clock
+import pose
+import game_map
+from vision_controller import (Marker, MARKER_ARENA, MARKER_ROBOT, MARKER_SLOT,
+                               MARKER_TOKEN_TOP, MARKER_TOKEN_BOTTOM,
+                               MARKER_TOKEN_SIDE)
+
+RANGE_ERROR = 0.05 # meters of position error per meter of range
+HELD_DISTANCE = 0.5 # meters, a token bottom this close is in the grabber
+
 class _Watcher(object):
+    half_life = None # seconds, None for things that never move
+
+    def __init__(self, code):
+        self.code = code
+        self.x = self.y = None
+        self.error = None # meters, how far off the position might be
+        self.seen_from = None # Pose of the robot at the last sighting
+        self.timestamp = None # of the last frame it was in
+        self.located = None # timestamp the position was last set
+        self.distance = None
+        self.sightings = 0
+
+    def seen(self, marker, timestamp, position):
+        """Update from a marker seen in the frame at timestamp, position the
+        Pose of the robot or None if it isn't known."""
+        if timestamp == self.timestamp:
+            return False # the same frame again
+        self.timestamp = timestamp
+        self.sightings += 1
+        self.distance = Marker(marker).horizontal_dist
+        self.seen_from = position
+        if position is not None:
+            self.x, self.y = pose.arena_position(position, marker)
+            self.error = position.error + RANGE_ERROR * self.distance
+            self.located = timestamp
+        return True
+
     def last_seen(self):
-        pass
+        return self.timestamp
+
     def get_id(self):
-        pass
+        return self.code
 
-class RobotWatcher(_Watcher):
+    def confidence(self, now=None):
+        """From 1 when just placed down to 0, 0 if it never was."""
+        if self.located is None:
+            return 0.0
+        if self.half_life is None:
+            return 1.0
+        age = max(0, (clock.time() if now is None else now) - self.located)
+        return 0.5 ** (age / self.half_life)
 
-    ROBOTS = {}
+    def __repr__(self):
+        if self.located is None:
+            return "%s(%d, not placed)" % (self.__class__.__name__, self.code)
+        return "%s(%d, (%.2f, %.2f) +-%.2fm, %.0f%%, seen %d times)" % (
+            self.__class__.__name__, self.code, self.x, self.y, self.error,
+            100 * self.confidence(), self.sightings)
 
-    class Robot:
-        def __init__(self, marker):
-            self.distance_away = marker.dist
+class RobotWatcher(_Watcher):
+    half_life = 3.0
 
+class TokenWatcher(_Watcher):
+    half_life = 30.0
 
-    def seen_robot(self, marker):
-        if marker.info.code not in self.ROBOTS:
-            self.ROBOTS[marker.info.code] = Robot(marker)
+    def __init__(self, code):
+        super(TokenWatcher, self).__init__(code)
+        self.held = False # last seen in our grabber
 
-class TokenWatcher(_Watcher):
-    def __init__(self, marker):
-        pass
+    def seen(self, marker, timestamp, position):
+        if not super(TokenWatcher, self).seen(marker, timestamp, position):
+            return False
+        self.held = (marker.info.marker_type == MARKER_TOKEN_BOTTOM and
+                     marker.dist <= HELD_DISTANCE)
+        return True
+
+    @property
+    def available(self):
+        """Not held by us and not on the slot platform already."""
+        if self.held:
+            return False
+        if self.located is None:
+            return True
+        x1, y1, x2, y2 = game_map.PLATFORM
+        return not (x1 <= self.x <= x2 and y1 <= self.y <= y2)
 
 class ArenaWatcher(_Watcher):
-    pass
\ No newline at end of file
+    """Arena and slot markers, these stay where game_map has them."""
+
+    def __init__(self, code):
+        super(ArenaWatcher, self).__init__(code)
+        known = game_map.ARENA_MARKERS.get(code) or game_map.SLOTS.get(code)
+        if known is not None:
+            self.x, self.y = known[:2]
+            self.error = 0.0
+
+    def seen(self, marker, timestamp, position):
+        x, y = self.x, self.y
+        if not super(ArenaWatcher, self).seen(marker, timestamp, position):
+            return False
+        if x is not None:
+            # Where it was seen is only a check on the tracked pose
+            self.x, self.y, self.error = x, y, 0.0
+        return True
+
+WATCHERS = {MARKER_ROBOT: RobotWatcher,
+            MARKER_TOKEN_TOP: TokenWatcher,
+            MARKER_TOKEN_BOTTOM: TokenWatcher,
+            MARKER_TOKEN_SIDE: TokenWatcher,
+            MARKER_ARENA: ArenaWatcher,
+            MARKER_SLOT: ArenaWatcher}
+
+class WorldModel(object):
+    """All the watchers, by kind and code. where is called with no arguments
+    for the Pose of the robot, None when it isn't known well enough."""
+
+    def __init__(self, where):
+        self.where = where
+        self.robots = {}
+        self.tokens = {}
+        self.fixed = {}
+        self._kinds = {RobotWatcher: self.robots, TokenWatcher: self.tokens,
+                       ArenaWatcher: self.fixed}
+
+    def update(self, markers):
+        """Take in every marker of a frame, for the marker callback."""
+        if not markers:
+            return
+        timestamp = getattr(markers, 'timestamp', None)
+        if timestamp is None:
+            timestamp = clock.time()
+        position = self.where()
+        for marker in markers:
+            kind = WATCHERS.get(marker.info.marker_type)
+            if kind is None:
+                continue
+            watchers = self._kinds[kind]
+            code = marker.info.code
+            if code not in watchers:
+                watchers[code] = kind(code)
+            watchers[code].seen(marker, timestamp, position)
+
+    def closest_token(self, codes, x, y, min_confidence=0.3):
+        """Returns the TokenWatcher of the available token with one of the
+        codes nearest the arena point, placed with at least min_confidence,
+        or None."""
+        now = clock.time()
+        found = [token for code, token in self.tokens.items()
+                 if code in codes and token.available and
+                 token.confidence(now) >= min_confidence]
+        if not found:
+            return None
+        return min(found, key=lambda t: (t.x - x) ** 2 + (t.y - y) ** 2)
+
+    def forget(self, watcher):
+        self._kinds[watcher.__class__].pop(watcher.code, None)
+
+    def __str__(self):
+        return "robots %s, tokens %s" % (
+            [self.robots[code] for code in sorted(self.robots)],
+            [self.tokens[code] for code in sorted(self.tokens)])